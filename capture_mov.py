@@ -2,253 +2,66 @@
 import asyncio
 import curses
 import os
-import shutil
-import tempfile
-from datetime import datetime
+import sys
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import Optional
 
-import aiohttp
-import onvif
 from dotenv import load_dotenv
 
-
-# -----------------------
-# helpers
-# -----------------------
-async def maybe_await(x):
-    return await x if asyncio.iscoroutine(x) else x
-
-
-def safe_get(obj, path: str, default=None):
-    cur = obj
-    for key in path.split("."):
-        if cur is None:
-            return default
-        cur = getattr(cur, key, None)
-    return default if cur is None else cur
-
-
-def pick_ptz_profile(profiles):
-    for p in profiles:
-        if getattr(p, "PTZConfiguration", None):
-            return p
-    return profiles[0]
-
-
-def ui_line(stdscr, row: int, text: str):
-    h, w = stdscr.getmaxyx()
-    stdscr.addstr(row, 0, " " * (w - 1))
-    stdscr.addstr(row, 0, text[: w - 1])
-
-
-def now_ts():
-    return datetime.now().strftime("%Y%m%d_%H%M%S")
-
-
-# -----------------------
-# ONVIF operations
-# -----------------------
-async def get_pos(ptz, token) -> Optional[Tuple[float, float]]:
-    st = await ptz.GetStatus({"ProfileToken": token})
-    x = safe_get(st, "Position.PanTilt.x", None)
-    y = safe_get(st, "Position.PanTilt.y", None)
-    if x is None or y is None:
-        return None
-    return float(x), float(y)
-
-
-async def goto_home(ptz, token) -> bool:
-    try:
-        req = ptz.create_type("GotoHomePosition")
-        req.ProfileToken = token
-        await ptz.GotoHomePosition(req)
-        return True
-    except Exception:
-        return False
-
-
-async def relative_move(ptz, token, dx: float, dy: float):
-    await ptz.RelativeMove(
-        {
-            "ProfileToken": token,
-            "Translation": {"PanTilt": {"x": dx, "y": dy}},
-        }
-    )
-
-
-async def get_ranges(ptz, cfg_token) -> Tuple[float, float, float, float]:
-    req = ptz.create_type("GetConfigurationOptions")
-    req.ConfigurationToken = cfg_token
-    opts = await ptz.GetConfigurationOptions(req)
-    spaces = getattr(opts, "Spaces", None)
-
-    abs_space = getattr(spaces, "AbsolutePanTiltPositionSpace", None) if spaces else None
-    if abs_space:
-        xr = abs_space[0].XRange
-        yr = abs_space[0].YRange
-        pan_min = float(getattr(xr, "Min", -1.0))
-        pan_max = float(getattr(xr, "Max", 1.0))
-        tilt_min = float(getattr(yr, "Min", -1.0))
-        tilt_max = float(getattr(yr, "Max", 1.0))
-        return pan_min, pan_max, tilt_min, tilt_max
-
-    return -1.0, 1.0, -1.0, 1.0
-
-
-# -----------------------
-# tilt auto calibration
-# -----------------------
-async def nudge_off_tilt_limit(ptz, token, tilt_min, tilt_max, settle: float):
-    p = await get_pos(ptz, token)
-    if p is None:
-        return
-    _, y = p
-    eps = 0.01
-    try:
-        if y >= tilt_max - eps:
-            await relative_move(ptz, token, 0.0, -0.12)
-            await asyncio.sleep(settle)
-        elif y <= tilt_min + eps:
-            await relative_move(ptz, token, 0.0, +0.12)
-            await asyncio.sleep(settle)
-    except Exception:
-        pass
-
-
-async def decide_tilt_up_sign_by_limit(
-    ptz, token, tilt_max: float, probe: float = 0.12, settle: float = 0.25
-) -> int:
-    p0 = await get_pos(ptz, token)
-    if p0 is None:
-        return +1
-    _, y0 = p0
-
-    async def try_dy(dy):
-        try:
-            await relative_move(ptz, token, 0.0, dy)
-            await asyncio.sleep(settle)
-            p = await get_pos(ptz, token)
-            return None if p is None else float(p[1])
-        except Exception:
-            return None
-
-    y_plus = await try_dy(+probe)
-    await try_dy(-probe)
-    y_minus = await try_dy(-probe)
-    await try_dy(+probe)
-
-    if y_plus is None or y_minus is None:
-        return +1
-    if abs(y_plus - y0) < 1e-3 and abs(y_minus - y0) < 1e-3:
-        return +1
-
-    dist_plus = abs(tilt_max - y_plus)
-    dist_minus = abs(tilt_max - y_minus)
-    return +1 if dist_plus <= dist_minus else -1
-
-
-# -----------------------
-# Photo capture (ONVIF -> RTSP fallback)
-# -----------------------
-async def fetch_bytes(url: str, username: str, password: str, timeout_sec: float = 6.0) -> bytes:
-    auth = aiohttp.BasicAuth(username, password)
-    timeout = aiohttp.ClientTimeout(total=timeout_sec)
-    async with aiohttp.ClientSession(auth=auth, timeout=timeout) as session:
-        async with session.get(url) as resp:
-            resp.raise_for_status()
-            return await resp.read()
-
-
-def get_rtsp_url(host: str, username: str, password: str) -> str:
-    return f"rtsp://{username}:{password}@{host}:554/stream1"
-
-
-async def capture_via_rtsp_ffmpeg(rtsp_url: str, timeout_sec: float = 10.0) -> bytes:
-    with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as tmp:
-        tmp_path = tmp.name
-
-    try:
-        cmd = [
-            "ffmpeg",
-            "-hide_banner",
-            "-loglevel",
-            "error",
-            "-rtsp_transport", "tcp",
-            "-y",
-            "-i", rtsp_url,
-            "-frames:v", "1",
-            "-q:v", "2",
-            "-f", "image2",
-            tmp_path,
-        ]
-
-        proc = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.DEVNULL,
-            stderr=asyncio.subprocess.PIPE,
-        )
-
-        try:
-            await asyncio.wait_for(proc.wait(), timeout=timeout_sec)
-        except asyncio.TimeoutError:
-            proc.kill()
-            raise RuntimeError("ffmpeg timeout while capturing frame")
-
-        if proc.returncode != 0:
-            err = (await proc.stderr.read()).decode("utf-8", errors="ignore")
-            err = err.strip().replace("\n", " ")
-            raise RuntimeError(f"ffmpeg failed (code={proc.returncode}): {err[:400]}")
-
-        return Path(tmp_path).read_bytes()
-
-    finally:
-        Path(tmp_path).unlink(missing_ok=True)
-
-
-async def capture_photo(cam, media, profile_token: str, username: str, password: str, host: str) -> bytes:
-    # 1) helper
-    try:
-        get_snapshot = getattr(cam, "get_snapshot", None)
-        if callable(get_snapshot):
-            data = await get_snapshot(profile_token)
-            if data:
-                return data
-    except Exception:
-        pass
-
-    # 2) SnapshotUri -> HTTP
-    try:
-        snap = await media.GetSnapshotUri({"ProfileToken": profile_token})
-        uri = getattr(snap, "Uri", None) or getattr(snap, "URI", None)
-        if uri:
-            return await fetch_bytes(uri, username, password)
-    except Exception:
-        pass
-
-    # 3) RTSP fallback
-    rtsp_url = os.environ.get("STREAM_URL") or get_rtsp_url(host, username, password)
-    return await capture_via_rtsp_ffmpeg(rtsp_url, timeout_sec=10.0)
-
-
-def save_bytes(data: bytes, out_dir: Path, prefix: str, ext: str) -> Path:
-    out_dir.mkdir(parents=True, exist_ok=True)
-    path = out_dir / f"{prefix}_{now_ts()}.{ext}"
-    path.write_bytes(data)
-    return path
+from onvif_camera.cache import cache_path
+from onvif_camera.ptz import goto_home
+from onvif_camera.snapshot import (
+    SnapshotState,
+    basic_auth_headers,
+    capture_photo,
+    create_digest_auth,
+    create_http_session,
+    photo_out_path,
+    unique_path,
+)
+from onvif_camera.startup import create_camera, load_ptz_settings, resolve_startup
+from onvif_camera.stream import (
+    SnapshotPump,
+    drain_stream,
+    get_rtsp_url,
+    hwaccel_args,
+    jpeg_output_args,
+    start_live_preview,
+    stop_ffmpeg,
+    stop_live_preview,
+)
+from onvif_camera.ui import (
+    MOVE_KEYS,
+    next_key,
+    setup_screen,
+    start_exit_watch,
+    start_key_reader,
+    stop_key_reader,
+    take_repeats,
+    ui_clear,
+    ui_flush,
+    ui_line,
+)
+
+try:
+    # uvloop（任意）
+    import uvloop
+except ImportError:
+    uvloop = None
 
 
 # -----------------------
 # Video recording (RTSP + ffmpeg)
 # -----------------------
 def video_out_path(out_dir: Path, ext: str = "mkv") -> Path:
-    out_dir.mkdir(parents=True, exist_ok=True)
-    return out_dir / f"record_{now_ts()}.{ext}"
+    return unique_path(out_dir, "record", ext)
 
 
-async def start_recording(rtsp_url: str, out_path: Path):
+async def start_recording(rtsp_url: str, out_path: Path, with_frames: bool = False, codec: Optional[str] = None):
     """
     途中停止でも壊れにくいように mkv で -c copy（再エンコード無し）
+    with_frames=True なら同じ入力からMJPEGもstdoutへ出す（撮影・ライブ表示と共有する）
+    stderr は録画中ずっと読み続ける。戻り値は (proc, stderrを読むタスク)
     """
     cmd = [
         "ffmpeg",
@@ -263,95 +76,35 @@ async def start_recording(rtsp_url: str, out_path: Path):
         "-y",
         str(out_path),
     ]
+    if with_frames:
+        cmd += [
+            "-map", "0:v",
+            "-an",
+            *jpeg_output_args(codec),
+            "-f", "image2pipe",
+            "pipe:1",
+        ]
     proc = await asyncio.create_subprocess_exec(
         *cmd,
         stdin=asyncio.subprocess.PIPE,
-        stdout=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE if with_frames else asyncio.subprocess.DEVNULL,
         stderr=asyncio.subprocess.PIPE,
+        start_new_session=sys.platform != "win32",
     )
-    return proc
+    stderr_task = asyncio.create_task(drain_stream(proc.stderr))
+    return proc, stderr_task
 
 
-async def stop_recording(proc) -> str:
-    """
-    ffmpeg に 'q' を送って終了させる（これが一番壊れにくい）
-    だめなら terminate -> kill
-    """
-    try:
-        if proc.stdin:
-            proc.stdin.write(b"q\n")
-            await proc.stdin.drain()
-    except Exception:
-        pass
-
-    try:
-        await asyncio.wait_for(proc.wait(), timeout=3.0)
-    except asyncio.TimeoutError:
-        try:
-            proc.terminate()
-        except Exception:
-            pass
-        try:
-            await asyncio.wait_for(proc.wait(), timeout=2.0)
-        except asyncio.TimeoutError:
-            try:
-                proc.kill()
-            except Exception:
-                pass
-            await proc.wait()
+async def stop_recording(proc, stderr_task) -> str:
+    # 録画はファイルを閉じるまで少しかかるので長めに待つ
+    await stop_ffmpeg(proc, grace=3.0, term_grace=2.0)
 
     err = ""
     try:
-        if proc.stderr:
-            err = (await proc.stderr.read()).decode("utf-8", errors="ignore").strip()
+        err = (await stderr_task).decode("utf-8", errors="ignore").strip()
     except Exception:
         pass
-    return err[:300]
-
-
-async def start_live_preview(rtsp_url: str):
-    if shutil.which("ffplay") is None:
-        raise RuntimeError("ffplay not found")
-
-    cmd = [
-        "ffplay",
-        "-hide_banner",
-        "-loglevel",
-        "error",
-        "-rtsp_transport",
-        "tcp",
-        "-fflags",
-        "nobuffer",
-        "-flags",
-        "low_delay",
-        "-framedrop",
-        "-window_title",
-        "ONVIF Live Preview",
-        rtsp_url,
-    ]
-    proc = await asyncio.create_subprocess_exec(
-        *cmd,
-        stdin=asyncio.subprocess.DEVNULL,
-        stdout=asyncio.subprocess.DEVNULL,
-        stderr=asyncio.subprocess.DEVNULL,
-    )
-    return proc
-
-
-async def stop_live_preview(proc):
-    try:
-        proc.terminate()
-    except Exception:
-        pass
-
-    try:
-        await asyncio.wait_for(proc.wait(), timeout=1.5)
-    except asyncio.TimeoutError:
-        try:
-            proc.kill()
-        except Exception:
-            pass
-        await proc.wait()
+    return err[-300:]
 
 
 # -----------------------
@@ -365,62 +118,52 @@ async def async_main(stdscr):
     user = os.environ["ONVIF_USER"]
     password = os.environ["ONVIF_PASSWORD"]
 
-    mount_mode = os.environ.get("MOUNT_MODE", "desk").strip().lower()
-
-    step = float(os.environ.get("PTZ_STEP", "0.10"))
-    margin = float(os.environ.get("PTZ_MARGIN", "0.02"))
-    settle = float(os.environ.get("PTZ_SETTLE_SEC", "0.12"))
-    probe = float(os.environ.get("PTZ_PROBE", "0.12"))
-    pan_sign_base = float(os.environ.get("PAN_SIGN", "-1.0"))
-
+    settings = load_ptz_settings()
     capture_dir = Path(os.environ.get("CAPTURE_DIR", "./captures"))
     video_dir = Path(os.environ.get("VIDEO_DIR", "./captures"))
     fixed_sec = float(os.environ.get("VIDEO_SECONDS", "10"))
-
-    curses.curs_set(0)
-    # 固定秒録画の自動停止を回すため、短い周期でキー入力をポーリングする
-    stdscr.nodelay(False)
-    stdscr.timeout(100)
-    stdscr.keypad(True)
-
-    wsdl_dir = f"{os.path.dirname(onvif.__file__)}/wsdl/"
-    cam = onvif.ONVIFCamera(host, port, user, password, wsdl_dir=wsdl_dir)
+    cache_file = cache_path(host)
+
+    # 保存先は撮影・録画のたびではなく、起動時に一度だけ作る
+    capture_dir.mkdir(parents=True, exist_ok=True)
+    video_dir.mkdir(parents=True, exist_ok=True)
+
+    setup_screen(stdscr)
+    cam = create_camera(host, port, user, password)
+    get_snapshot = getattr(cam, "get_snapshot", None)
+    snap_state = SnapshotState(
+        get_snapshot=get_snapshot if callable(get_snapshot) else None,
+        basic_headers=basic_auth_headers(user, password),
+        digest_auth=create_digest_auth(user, password),
+    )
 
     video_proc = None
+    video_stderr = None
     video_path: Optional[Path] = None
+    session = None
+    # RTSPのURLは起動中に変わらないので一度だけ組み立てる
+    rtsp_url = os.environ.get("STREAM_URL") or get_rtsp_url(host, user, password)
+    hwaccel = os.environ.get("HWACCEL", "none").strip().lower()
+    pump = SnapshotPump(rtsp_url, input_args=await hwaccel_args(hwaccel))
     live_proc = None
     fixed_recording_deadline: Optional[float] = None
 
     try:
         ui_line(stdscr, 0, "connecting ...")
-        stdscr.refresh()
+        ui_flush(stdscr)
 
         await cam.update_xaddrs()
+        session = create_http_session()
 
-        media = await maybe_await(cam.create_media_service())
-        profiles = await media.GetProfiles()
-        profile = pick_ptz_profile(profiles)
-        token = profile.token
-
-        ptz = await maybe_await(cam.create_ptz_service())
-        pan_min, pan_max, tilt_min, tilt_max = await get_ranges(ptz, profile.PTZConfiguration.token)
-
-        pan_sign = pan_sign_base
-        if mount_mode == "ceiling":
-            pan_sign *= -1.0
-
-        ui_line(stdscr, 0, "calibrating tilt ...")
-        ui_line(stdscr, 2, f"range pan[{pan_min:.2f},{pan_max:.2f}] tilt[{tilt_min:.2f},{tilt_max:.2f}]")
-        stdscr.refresh()
+        st = await resolve_startup(stdscr, cam, settings, cache_file)
+        mover = st.mover
+        # コーデックが分かっていれば、撮影の前にffprobeで調べなくて済む
+        pump.codec = st.video_codec
+        if st.cache is not None:
+            # 前回うまくいった撮影経路から試す
+            snap_state.strategy = st.cache.get("snapshot_strategy")
 
-        await nudge_off_tilt_limit(ptz, token, tilt_min, tilt_max, settle=settle)
-        tilt_up_sign = await decide_tilt_up_sign_by_limit(ptz, token, tilt_max, probe=probe, settle=max(0.20, settle))
-        if mount_mode == "ceiling":
-            tilt_up_sign *= -1
-
-        pos = await get_pos(ptz, token)
-
-        stdscr.clear()
+        ui_clear(stdscr)
         ui_line(stdscr, 0, "PTZ keyboard control (RelativeMove + photo + video)")
         ui_line(stdscr, 2, "Arrow / WASD : move")
         ui_line(stdscr, 4, "h            : go home (if supported)")
@@ -430,9 +173,13 @@ async def async_main(stdscr):
         ui_line(stdscr, 8, f"V            : record {fixed_sec:.0f}s video")
         ui_line(stdscr, 9, "l            : start/stop live preview")
         ui_line(stdscr, 10, "q            : quit")
-        ui_line(stdscr, 11, f"step={step} margin={margin} settle={settle} mount={mount_mode}")
-        ui_line(stdscr, 12, f"tilt_up_sign={tilt_up_sign:+d}")
-        stdscr.refresh()
+        ui_line(stdscr, 11, f"step={settings.step} margin={settings.margin} settle={settings.settle} mount={settings.mount_mode}")
+        ui_line(stdscr, 12, f"tilt_up_sign={mover.tilt_up_sign:+d}")
+        ui_flush(stdscr)
+
+        key_queue: asyncio.Queue = asyncio.Queue()
+        start_key_reader(stdscr, key_queue)
+        pending_key = None
 
         while True:
             loop_now = asyncio.get_running_loop().time()
@@ -443,7 +190,8 @@ async def async_main(stdscr):
                 and fixed_recording_deadline is not None
                 and loop_now >= fixed_recording_deadline
             ):
-                err = await stop_recording(video_proc)
+                err = await stop_recording(video_proc, video_stderr)
+                await pump.release(video_proc)
                 ui_line(stdscr, 17, f"video saved: {video_path}" if video_path else "video stopped")
                 if err:
                     ui_line(stdscr, 18, f"ffmpeg: {err[:120]}")
@@ -457,8 +205,8 @@ async def async_main(stdscr):
                 live_proc = None
                 ui_line(stdscr, 17, "live preview stopped")
 
-            if pos is not None:
-                x, y = pos
+            if mover.pos is not None:
+                x, y = mover.pos
                 ui_line(stdscr, 14, f"pos pan={x:+.3f} tilt={y:+.3f}")
             else:
                 ui_line(stdscr, 14, "pos (not available)")
@@ -473,52 +221,77 @@ async def async_main(stdscr):
                 ui_line(stdscr, 15, "video: idle")
             ui_line(stdscr, 16, "live: on" if live_proc is not None else "live: off")
 
-            stdscr.refresh()
+            ui_flush(stdscr)
 
-            key = stdscr.getch()
+            # 固定秒録画中は、残り秒数の表示が変わる時刻か締め切りで起きる
+            timeout = None
+            if fixed_recording_deadline is not None:
+                remain_f = max(0.0, fixed_recording_deadline - loop_now)
+                timeout = min(remain_f, remain_f % 1.0 + 0.01)
+            if mover.idle_timeout is not None:
+                timeout = mover.idle_timeout if timeout is None else min(timeout, mover.idle_timeout)
+
+            if pending_key is not None:
+                key, pending_key = pending_key, None
+            else:
+                key = await next_key(key_queue, timeout)
             if key == -1:
+                await mover.idle_sync()
                 continue
 
             if key in (ord("q"), ord("Q")):
                 break
 
             if key in (ord("h"), ord("H")):
-                ok = await goto_home(ptz, token)
+                ok = await goto_home(st.ptz, st.token)
                 ui_line(stdscr, 17, "home: ok" if ok else "home: not supported / failed")
-                stdscr.refresh()
+                ui_flush(stdscr)
                 await asyncio.sleep(0.4)
-                pos = await get_pos(ptz, token)
+                await mover.sync()
                 continue
 
             if key in (ord("i"), ord("I")):
-                tilt_up_sign *= -1
+                tilt_up_sign = await st.invert_tilt()
                 ui_line(stdscr, 12, f"tilt_up_sign={tilt_up_sign:+d}")
                 ui_line(stdscr, 17, "tilt inverted")
-                stdscr.refresh()
+                await mover.sync()
                 continue
 
             if key in (ord("p"), ord("P")):
                 ui_line(stdscr, 17, "capturing photo ...")
-                stdscr.refresh()
+                ui_flush(stdscr)
                 try:
-                    img = await capture_photo(cam, media, token, user, password, host)
-                    path = save_bytes(img, capture_dir, "capture", "jpg")
+                    # 録画がフレームを分けていない（常駐ffmpegが止まっている）ときは、
+                    # 2本目のRTSPをつなぎっぱなしにしないように単発で取る
+                    path = await capture_photo(
+                        st.media,
+                        session,
+                        pump,
+                        snap_state,
+                        st.token,
+                        photo_out_path(capture_dir),
+                        keep_pump=video_proc is None,
+                    )
                     ui_line(stdscr, 17, f"saved: {path}")
                 except Exception as e:
                     ui_line(stdscr, 17, f"photo failed: {type(e).__name__}: {e}")
-                stdscr.refresh()
+                await st.remember_snapshot_route(snap_state.strategy, pump.codec)
+                await mover.sync()
                 continue
 
             # v: toggle recording
             if key == ord("v"):
-                rtsp_url = os.environ.get("STREAM_URL") or get_rtsp_url(host, user, password)
 
                 if video_proc is None:
                     video_path = video_out_path(video_dir, ext="mkv")
                     ui_line(stdscr, 17, f"video start ... {video_path}")
-                    stdscr.refresh()
+                    ui_flush(stdscr)
                     try:
-                        video_proc = await start_recording(rtsp_url, video_path)
+                        # 撮影やライブ表示でRTSPを使っているなら、録画と同じ接続にまとめる
+                        share = pump.running
+                        video_proc, video_stderr = await start_recording(rtsp_url, video_path, with_frames=share, codec=pump.codec)
+                        if share:
+                            await pump.attach(video_proc)
                         fixed_recording_deadline = None
                         ui_line(stdscr, 17, "video recording started")
                     except Exception as e:
@@ -526,11 +299,11 @@ async def async_main(stdscr):
                         video_path = None
                         fixed_recording_deadline = None
                         ui_line(stdscr, 17, f"video start failed: {type(e).__name__}: {e}")
-                    stdscr.refresh()
                 else:
                     ui_line(stdscr, 17, "video stopping ...")
-                    stdscr.refresh()
-                    err = await stop_recording(video_proc)
+                    ui_flush(stdscr)
+                    err = await stop_recording(video_proc, video_stderr)
+                    await pump.release(video_proc)
                     ui_line(stdscr, 17, f"video saved: {video_path}" if video_path else "video stopped")
                     if err:
                         # うるさければ消してOK。問題切り分け用に一応残す。
@@ -540,21 +313,21 @@ async def async_main(stdscr):
                     video_proc = None
                     video_path = None
                     fixed_recording_deadline = None
-                    stdscr.refresh()
                 continue
 
             # V: fixed duration recording
             if key == ord("V"):
-                rtsp_url = os.environ.get("STREAM_URL") or get_rtsp_url(host, user, password)
                 path = video_out_path(video_dir, ext="mkv")
                 if video_proc is not None:
                     ui_line(stdscr, 17, "video is already recording")
-                    stdscr.refresh()
                     continue
                 ui_line(stdscr, 17, f"recording {fixed_sec:.0f}s ... {path}")
-                stdscr.refresh()
+                ui_flush(stdscr)
                 try:
-                    video_proc = await start_recording(rtsp_url, path)
+                    share = pump.running
+                    video_proc, video_stderr = await start_recording(rtsp_url, path, with_frames=share, codec=pump.codec)
+                    if share:
+                        await pump.attach(video_proc)
                     video_path = path
                     fixed_recording_deadline = asyncio.get_running_loop().time() + max(0.0, fixed_sec)
                     ui_line(stdscr, 17, "video recording started")
@@ -564,102 +337,47 @@ async def async_main(stdscr):
                     video_path = None
                     fixed_recording_deadline = None
                     ui_line(stdscr, 17, f"video failed: {type(e).__name__}: {e}")
-                stdscr.refresh()
                 continue
 
             if key in (ord("l"), ord("L")):
                 if live_proc is None:
-                    rtsp_url = os.environ.get("STREAM_URL") or get_rtsp_url(host, user, password)
                     ui_line(stdscr, 17, "live preview starting ...")
-                    stdscr.refresh()
+                    ui_flush(stdscr)
                     try:
-                        live_proc = await start_live_preview(rtsp_url)
+                        live_proc = await start_live_preview(rtsp_url, pump)
+                        start_exit_watch(live_proc, key_queue)
                         ui_line(stdscr, 17, "live preview started")
                     except Exception as e:
                         live_proc = None
                         ui_line(stdscr, 17, f"live preview failed: {type(e).__name__}: {e}")
                 else:
                     ui_line(stdscr, 17, "live preview stopping ...")
-                    stdscr.refresh()
+                    ui_flush(stdscr)
                     await stop_live_preview(live_proc)
                     live_proc = None
                     ui_line(stdscr, 17, "live preview stopped")
-                stdscr.refresh()
                 continue
 
-            dx = 0.0
-            dy = 0.0
-            msg = ""
-
-            if pos is not None:
-                x, y = pos
-                pan_lo = pan_min + margin
-                pan_hi = pan_max - margin
-                tilt_lo = tilt_min + margin
-                tilt_hi = tilt_max - margin
-            else:
-                pan_lo, pan_hi, tilt_lo, tilt_hi = pan_min, pan_max, tilt_min, tilt_max
-
-            if key in (curses.KEY_RIGHT, ord("d"), ord("D")):
-                if pos is not None and x >= pan_hi:
-                    msg = "blocked: right limit"
-                else:
-                    dx = +step * pan_sign
-
-            elif key in (curses.KEY_LEFT, ord("a"), ord("A")):
-                if pos is not None and x <= pan_lo:
-                    msg = "blocked: left limit"
-                else:
-                    dx = -step * pan_sign
-
-            elif key in (curses.KEY_UP, ord("w"), ord("W")):
-                if pos is not None:
-                    if tilt_up_sign > 0 and y >= tilt_hi:
-                        msg = "blocked: up limit"
-                    elif tilt_up_sign < 0 and y <= tilt_lo:
-                        msg = "blocked: up limit"
-                    else:
-                        dy = +step * tilt_up_sign
-                else:
-                    dy = +step * tilt_up_sign
-
-            elif key in (curses.KEY_DOWN, ord("s"), ord("S")):
-                down_sign = -tilt_up_sign
-                if pos is not None:
-                    if down_sign > 0 and y >= tilt_hi:
-                        msg = "blocked: down limit"
-                    elif down_sign < 0 and y <= tilt_lo:
-                        msg = "blocked: down limit"
-                    else:
-                        dy = +step * down_sign
-                else:
-                    dy = +step * down_sign
-
-            if dx != 0.0 or dy != 0.0:
-                try:
-                    await relative_move(ptz, token, dx, dy)
-                    await asyncio.sleep(settle)
-                except Exception as e1:
-                    # 録画中は失敗しやすい個体があるため、移動量を半分にして1回だけ再試行する
-                    try:
-                        await relative_move(ptz, token, dx * 0.5, dy * 0.5)
-                        await asyncio.sleep(settle)
-                        msg = "移動: 半分のステップで再試行しました"
-                    except Exception as e2:
-                        detail = str(e2).strip().replace("\n", " ")
-                        if not detail:
-                            detail = str(e1).strip().replace("\n", " ")
-                        msg = f"移動エラー: {detail[:120]}"
-
+            # 押しっぱなしで溜まった同じ向きのキーは、まとめて1回のRelativeMoveにする
+            direction = MOVE_KEYS.get(key)
+            if direction is None:
+                continue
+            repeat, pending_key = take_repeats(key_queue, direction)
+            # 録画中は失敗しやすい個体があるため、移動量を半分にして1回だけ再試行する
+            msg = await mover.move(direction, repeat, retry_half=True)
             ui_line(stdscr, 17, msg)
-            stdscr.refresh()
-            pos = await get_pos(ptz, token)
+            ui_flush(stdscr)
+            await mover.settle()
 
     finally:
+        try:
+            stop_key_reader(stdscr)
+        except Exception:
+            pass
         # 録画中なら止めてから終了
         if video_proc is not None:
             try:
-                await stop_recording(video_proc)
+                await stop_recording(video_proc, video_stderr)
             except Exception:
                 pass
         if live_proc is not None:
@@ -667,6 +385,12 @@ async def async_main(stdscr):
                 await stop_live_preview(live_proc)
             except Exception:
                 pass
+        try:
+            await pump.stop()
+        except Exception:
+            pass
+        if session is not None:
+            await session.close()
         try:
             await cam.close()
         except Exception:
@@ -674,7 +398,11 @@ async def async_main(stdscr):
 
 
 def main():
-    curses.wrapper(lambda stdscr: asyncio.run(async_main(stdscr)))
+    # uvloopが入っていればイベントループを差し替える（Windowsは対象外）
+    loop_factory = None
+    if uvloop is not None and sys.platform != "win32":
+        loop_factory = uvloop.new_event_loop
+    curses.wrapper(lambda stdscr: asyncio.run(async_main(stdscr), loop_factory=loop_factory))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,3 @@
+"""
+ptz.py / capture_pic.py / capture_mov.py で共通に使う部品
+"""
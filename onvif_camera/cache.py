@@ -0,0 +1,78 @@
+"""
+起動時キャッシュ（プロファイル・範囲・tiltの向きなど、前回の起動で調べた結果）
+"""
+import asyncio
+import json
+import os
+from pathlib import Path
+from typing import Optional, Tuple
+
+from .ptz import maybe_await
+
+
+def cache_path(host: str) -> Optional[Path]:
+    # ONVIF_CACHE_DIR を空にするとキャッシュを使わない
+    cache_dir = os.environ.get("ONVIF_CACHE_DIR", "~/.cache")
+    if not cache_dir:
+        return None
+    return Path(cache_dir).expanduser() / f"onvif_{host}.json"
+
+
+async def get_device_key(cam) -> Optional[str]:
+    # 同じ機種・同じ個体のときだけキャッシュを使う
+    try:
+        device = await maybe_await(cam.create_devicemgmt_service())
+        info = await device.GetDeviceInformation()
+    except Exception:
+        return None
+    return "/".join(str(getattr(info, k, None) or "") for k in ("Manufacturer", "Model", "SerialNumber"))
+
+
+def _read_cache(path: Path, device_key: str) -> Optional[dict]:
+    try:
+        data = json.loads(path.read_text(encoding="utf-8"))
+        if data.get("device") != device_key:
+            return None
+        pan_min, pan_max, tilt_min, tilt_max = (float(v) for v in data["ranges"])
+        # PTZ_TILT_UP_SIGN で決めていた起動のキャッシュには符号が無い（None なら起動時に判定する）
+        tilt_up_sign = data.get("tilt_up_sign")
+        if tilt_up_sign is not None:
+            tilt_up_sign = +1 if int(tilt_up_sign) > 0 else -1
+        # ほかのスクリプトが書いた項目（撮影経路など）も消さずに持っておく
+        return {
+            **data,
+            "token": str(data["token"]),
+            "ranges": [pan_min, pan_max, tilt_min, tilt_max],
+            "tilt_up_sign": tilt_up_sign,
+        }
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        # 無い・壊れているときは調べ直して書き直す
+        return None
+
+
+async def load_startup_cache(cam, path: Optional[Path]) -> Tuple[Optional[str], Optional[dict]]:
+    if path is None:
+        return None, None
+    device_key = await get_device_key(cam)
+    return device_key, await load_cache(path, device_key)
+
+
+async def load_cache(path: Optional[Path], device_key: Optional[str]) -> Optional[dict]:
+    if path is None or device_key is None:
+        return None
+    return await asyncio.to_thread(_read_cache, path, device_key)
+
+
+def _write_cache(path: Path, data: dict):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(data, indent=2), encoding="utf-8")
+
+
+async def save_cache(path: Optional[Path], data: dict):
+    if path is None:
+        return
+    try:
+        await asyncio.to_thread(_write_cache, path, data)
+    except OSError:
+        # 書けなくても操作には困らないので無視
+        pass
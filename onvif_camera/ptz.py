@@ -0,0 +1,342 @@
+"""
+PTZの操作（RelativeMove・位置の取得・tiltの向きの判定）
+"""
+import asyncio
+import operator
+from typing import Optional, Tuple
+
+
+async def maybe_await(x):
+    return await x if asyncio.iscoroutine(x) else x
+
+
+def clamp(v, lo, hi):
+    return lo if v < lo else hi if v > hi else v
+
+
+# 何回動かしたら実際の位置を取り直すか（それまでは送った移動量から見積もる）
+POS_SYNC_MOVES = 5
+# 見積もりの位置のままキーがこの秒数来なければ、実際の位置を取り直す
+POS_IDLE_SYNC_SEC = 0.5
+
+# まとめて動かしたときの待ち時間は移動量に合わせて延ばす（ただしこの倍率まで）
+MAX_SETTLE_SCALE = 4
+# まとめるキーの数の上限（端末が詰まって大量に溜まっても、1回で大きく飛ばない）
+MAX_MOVE_REPEAT = 10
+
+
+def clamp_delta(cur: float, d: float, lo: float, hi: float) -> float:
+    # 移動先が範囲を越えないように移動量だけ詰める（向きは変えない）
+    if d > 0:
+        return min(d, max(0.0, hi - cur))
+    if d < 0:
+        return max(d, min(0.0, lo - cur))
+    return d
+
+
+def pick_ptz_tokens(profiles) -> Tuple[str, Optional[str]]:
+    # 使うのはトークンだけなので、文字列にして取り出す（zeepの大きなオブジェクトは持ち続けない）
+    profile = profiles[0]
+    for p in profiles:
+        if getattr(p, "PTZConfiguration", None):
+            profile = p
+            break
+    cfg = getattr(profile, "PTZConfiguration", None)
+    return str(profile.token), (str(cfg.token) if cfg is not None else None)
+
+
+# -----------------------
+# ONVIF operations
+# -----------------------
+# GetStatusは頻繁に呼ぶので、属性のたどり方は先に作っておく
+_GET_POS_X = operator.attrgetter("Position.PanTilt.x")
+_GET_POS_Y = operator.attrgetter("Position.PanTilt.y")
+
+
+async def get_pos(ptz, token) -> Optional[Tuple[float, float]]:
+    st = await ptz.GetStatus({"ProfileToken": token})
+    try:
+        return float(_GET_POS_X(st)), float(_GET_POS_Y(st))
+    except (AttributeError, TypeError):
+        # 途中が None（位置を返さない機種）ならここに来る
+        return None
+
+
+# 要求は毎回組み立て直さず、トークンごとに1つ作って使い回す
+_home_reqs: dict = {}
+_move_reqs: dict = {}
+
+
+async def goto_home(ptz, token) -> bool:
+    try:
+        req = _home_reqs.get(token)
+        if req is None:
+            req = ptz.create_type("GotoHomePosition")
+            req.ProfileToken = token
+            _home_reqs[token] = req
+        await ptz.GotoHomePosition(req)
+        return True
+    except Exception:
+        return False
+
+
+async def relative_move(ptz, token, dx: float, dy: float):
+    """
+    Tapo系は create_type("RelativeMove") でネストが None のままだと
+    嫌がることがあるので、辞書で“全部埋めて”送ります。
+    """
+    # 値だけ入れ替えて送る（送り終わるまで次の移動は来ないので、使い回しても混ざらない）
+    req = _move_reqs.get(token)
+    if req is None:
+        req = _move_reqs[token] = {
+            "ProfileToken": token,
+            "Translation": {"PanTilt": {"x": 0.0, "y": 0.0}},
+        }
+    pan_tilt = req["Translation"]["PanTilt"]
+    pan_tilt["x"] = dx
+    pan_tilt["y"] = dy
+    await ptz.RelativeMove(req)
+
+
+async def settle_and_get_pos(ptz, token, settle: float, lead: float = 0.9) -> Optional[Tuple[float, float]]:
+    # 待ちの終わりぎわにGetStatusを投げて、SOAPの往復を待ち時間に重ねる
+    async def delayed_get_pos():
+        await asyncio.sleep(settle * lead)
+        return await get_pos(ptz, token)
+
+    _, p = await asyncio.gather(asyncio.sleep(settle), delayed_get_pos())
+    return p
+
+
+async def get_ranges(ptz, cfg_token) -> Tuple[float, float, float, float]:
+    """
+    あなたの出力どおり、-1..+1 が取れる前提。
+    取れなくても -1..+1 にフォールバック。
+    """
+    req = ptz.create_type("GetConfigurationOptions")
+    req.ConfigurationToken = cfg_token
+    opts = await ptz.GetConfigurationOptions(req)
+    spaces = getattr(opts, "Spaces", None)
+
+    abs_space = getattr(spaces, "AbsolutePanTiltPositionSpace", None) if spaces else None
+    if abs_space:
+        xr = abs_space[0].XRange
+        yr = abs_space[0].YRange
+        pan_min = float(getattr(xr, "Min", -1.0))
+        pan_max = float(getattr(xr, "Max", 1.0))
+        tilt_min = float(getattr(yr, "Min", -1.0))
+        tilt_max = float(getattr(yr, "Max", 1.0))
+        return pan_min, pan_max, tilt_min, tilt_max
+
+    return -1.0, 1.0, -1.0, 1.0
+
+
+# -----------------------
+# tilt auto calibration
+# -----------------------
+async def nudge_off_tilt_limit(ptz, token, tilt_min, tilt_max, settle: float, p=None):
+    """
+    tilt が端に張り付いてると判定が外れやすいので、少しだけ中へ寄せます。
+    今の位置が分かっていれば p で渡す（GetStatusを1回省ける）。
+    """
+    if p is None:
+        p = await get_pos(ptz, token)
+    if p is None:
+        return
+    _, y = p
+    eps = 0.01
+
+    if y >= tilt_max - eps:
+        # 上限に張り付き → 少し下へ（符号は未確定なので両方試す）
+        try:
+            await relative_move(ptz, token, 0.0, -0.12)
+            await asyncio.sleep(settle)
+        except Exception:
+            pass
+    elif y <= tilt_min + eps:
+        # 下限に張り付き → 少し上へ（符号は未確定なので両方試す）
+        try:
+            await relative_move(ptz, token, 0.0, +0.12)
+            await asyncio.sleep(settle)
+        except Exception:
+            pass
+
+
+async def decide_tilt_up_sign_by_limit(
+    ptz, token, tilt_max: float, probe: float = 0.12, settle: float = 0.25
+) -> int:
+    """
+    「UPキー＝tilt を tilt_max 側へ近づける」と定義して、
+    dy=+probe / dy=-probe のどっちが tilt_max に近づくかで決めます。
+
+    return:
+      +1 -> UPキーで dy=+step
+      -1 -> UPキーで dy=-step
+    """
+    p0 = await get_pos(ptz, token)
+    if p0 is None:
+        return +1
+    _, y0 = p0
+
+    async def try_dy(dy):
+        try:
+            await relative_move(ptz, token, 0.0, dy)
+            p = await settle_and_get_pos(ptz, token, settle)
+            return None if p is None else float(p[1])
+        except Exception:
+            return None
+
+    # +probe を試す
+    y_plus = await try_dy(+probe)
+    # だいたい戻す
+    await try_dy(-probe)
+    # -probe を試す
+    y_minus = await try_dy(-probe)
+    # だいたい戻す
+    await try_dy(+probe)
+
+    if y_plus is None or y_minus is None:
+        # 取れない/失敗したら、手動反転 i に任せる（まずは +1）
+        return +1
+
+    # “tilt_max に近い方” を UP に採用
+    dist_plus = abs(tilt_max - y_plus)
+    dist_minus = abs(tilt_max - y_minus)
+
+    # 変化が全くないなら、どっちでも同じ → +1
+    if abs(y_plus - y0) < 1e-3 and abs(y_minus - y0) < 1e-3:
+        return +1
+
+    return +1 if dist_plus <= dist_minus else -1
+
+
+# -----------------------
+# keyboard move
+# -----------------------
+class PtzMover:
+    """
+    ユーザー視点の向き（"right" / "left" / "up" / "down"）で動かす。
+    端ガード・送った移動量からの位置の見積もり・ときどきの合わせ直しはここでやる。
+    """
+
+    def __init__(self, ptz, token, ranges, margin: float, step: float, settle: float, pan_sign: float, tilt_up_sign: int):
+        self.ptz = ptz
+        self.token = token
+        self.pan_min, self.pan_max, self.tilt_min, self.tilt_max = ranges
+        # 端ガードで止める位置（起動中は変わらないので先に決めておく）
+        self.pan_lo = self.pan_min + margin
+        self.pan_hi = self.pan_max - margin
+        self.tilt_lo = self.tilt_min + margin
+        self.tilt_hi = self.tilt_max - margin
+        self.step = step
+        self.settle_sec = settle
+        self.pan_sign = pan_sign
+        self.tilt_up_sign = tilt_up_sign
+        self.pos: Optional[Tuple[float, float]] = None
+        self.moves_since_sync = 0
+        # move() で送った移動（settle() で位置を見積もる）。(dx, dy, 待ち時間) か、送れなかったら None
+        self._sent: Optional[Tuple[float, float, float]] = None
+
+    @property
+    def idle_timeout(self) -> Optional[float]:
+        # 位置が見積もりのままなら、キーが来なくても起きて合わせ直す
+        return POS_IDLE_SYNC_SEC if self.moves_since_sync else None
+
+    async def sync(self):
+        self.pos = await get_pos(self.ptz, self.token)
+        self.moves_since_sync = 0
+
+    async def idle_sync(self):
+        # 位置が見積もりのままなら、手が空いたところで実際の位置に合わせ直す
+        if not self.moves_since_sync:
+            return
+        try:
+            await self.sync()
+        except Exception:
+            pass
+
+    def _delta(self, direction: str, move_step: float) -> Tuple[float, float, str]:
+        # 端ガード（posが取れるときだけ。取れないならガード無し）
+        # 注意：ここは “ユーザー視点” ではなく “ONVIF値の範囲” で止めます
+        pos = self.pos
+        if direction in ("right", "left"):
+            dx = move_step * self.pan_sign * (+1 if direction == "right" else -1)
+            if pos is not None and (
+                (dx > 0 and pos[0] >= self.pan_hi) or (dx < 0 and pos[0] <= self.pan_lo)
+            ):
+                return 0.0, 0.0, f"blocked: {direction} limit"
+            return dx, 0.0, ""
+        if direction in ("up", "down"):
+            # UP = tilt_max 側へ近づく（tilt_up_sign がその符号）。DOWN はその反対
+            dy = move_step * self.tilt_up_sign * (+1 if direction == "up" else -1)
+            if pos is not None and (
+                (dy > 0 and pos[1] >= self.tilt_hi) or (dy < 0 and pos[1] <= self.tilt_lo)
+            ):
+                return 0.0, 0.0, f"blocked: {direction} limit"
+            return 0.0, dy, ""
+        return 0.0, 0.0, ""
+
+    async def move(self, direction: str, repeat: int = 1, retry_half: bool = False) -> str:
+        """
+        RelativeMoveを送るだけ（待ちと位置の更新は settle() で）。
+        repeat はまとめたキーの数。戻り値は画面に出すメッセージ（無ければ空文字）。
+        retry_half=True なら、失敗したときに移動量を半分にして1回だけ再試行する。
+        """
+        repeat = min(repeat, MAX_MOVE_REPEAT)
+        dx, dy, msg = self._delta(direction, self.step * repeat)
+        move_settle = self.settle_sec * min(repeat, MAX_SETTLE_SCALE)
+
+        if self.pos is not None:
+            x, y = self.pos
+            dx = clamp_delta(x, dx, self.pan_lo, self.pan_hi)
+            dy = clamp_delta(y, dy, self.tilt_lo, self.tilt_hi)
+        else:
+            # 位置が分からないときも、範囲の幅より大きくは動かさない
+            dx = clamp(dx, -(self.pan_hi - self.pan_lo), self.pan_hi - self.pan_lo)
+            dy = clamp(dy, -(self.tilt_hi - self.tilt_lo), self.tilt_hi - self.tilt_lo)
+
+        moved = False
+        if dx != 0.0 or dy != 0.0:
+            try:
+                await relative_move(self.ptz, self.token, dx, dy)
+                moved = True
+            except Exception as e1:
+                if not retry_half:
+                    msg = f"error: {type(e1).__name__}"
+                else:
+                    try:
+                        await relative_move(self.ptz, self.token, dx * 0.5, dy * 0.5)
+                        # 位置の見積もりには実際に送った移動量を使う
+                        dx, dy = dx * 0.5, dy * 0.5
+                        moved = True
+                        msg = "移動: 半分のステップで再試行しました"
+                    except Exception as e2:
+                        detail = str(e2).strip().replace("\n", " ")
+                        if not detail:
+                            detail = str(e1).strip().replace("\n", " ")
+                        msg = f"移動エラー: {detail[:120]}"
+
+        self._sent = (dx, dy, move_settle) if moved else None
+        return msg
+
+    async def settle(self):
+        # move() のあとに呼ぶ（メッセージを画面に出してから待つ）
+        sent, self._sent = self._sent, None
+        if sent is None:
+            # 止められた・失敗したときは実際の位置を見る
+            await self.sync()
+            return
+
+        dx, dy, move_settle = sent
+        self.moves_since_sync += 1
+        if self.moves_since_sync < POS_SYNC_MOVES:
+            # 送った移動量で位置を見積もる（GetStatusの往復を待たない）
+            if self.pos is not None:
+                x, y = self.pos
+                self.pos = (clamp(x + dx, self.pan_min, self.pan_max), clamp(y + dy, self.tilt_min, self.tilt_max))
+            await asyncio.sleep(move_settle)
+        else:
+            # ときどき実際の位置で合わせ直す（見積もりのずれが溜まらないように）
+            # 待ちの終わりぎわにGetStatusを重ねて、次のキーを早く受け付ける
+            self.pos = await settle_and_get_pos(self.ptz, self.token, move_settle, lead=0.75)
+            self.moves_since_sync = 0
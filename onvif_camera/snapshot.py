@@ -0,0 +1,244 @@
+"""
+静止画の撮影（ONVIFのスナップショット -> RTSPの順に試す）
+"""
+import asyncio
+import base64
+import io
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Optional
+
+import aiohttp
+from yarl import URL
+
+from .stream import SnapshotPump, capture_via_rtsp_ffmpeg
+
+try:
+    # PyAV（任意）。入っていれば単発のRTSP取得をプロセス起動なしで行う
+    import av
+except ImportError:
+    av = None
+
+try:
+    # PyTurboJPEG（任意）。入っていればPyAVで取ったフレームのJPEG化をlibjpeg-turboで行う
+    from turbojpeg import TurboJPEG
+
+    tj = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    # ライブラリ本体（libturbojpeg）が見つからないときも使わない
+    tj = None
+
+
+def now_ts():
+    return time.strftime("%Y%m%d_%H%M%S")
+
+
+def unique_path(out_dir: Path, prefix: str, ext: str) -> Path:
+    # 同じ秒に続けて保存しても上書きしないように、連番を付ける
+    ts = now_ts()
+    path = out_dir / f"{prefix}_{ts}.{ext}"
+    n = 1
+    while path.exists():
+        path = out_dir / f"{prefix}_{ts}_{n}.{ext}"
+        n += 1
+    return path
+
+
+def create_http_session(timeout_sec: float = 6.0) -> aiohttp.ClientSession:
+    # 連写しても毎回つなぎ直さないように、セッションは起動中ずっと使い回す
+    # （認証はリクエストごとに付ける。URLに認証情報が入っているカメラもあるので、セッションの既定にはしない）
+    return aiohttp.ClientSession(
+        timeout=aiohttp.ClientTimeout(total=timeout_sec),
+        connector=aiohttp.TCPConnector(limit=8, keepalive_timeout=30, ttl_dns_cache=300),
+    )
+
+
+def basic_auth_headers(username: str, password: str) -> dict:
+    # Basic認証のヘッダは先に作っておき、リクエストのたびにエンコードしない
+    basic = base64.b64encode(f"{username}:{password}".encode("utf-8")).decode("ascii")
+    return {"Authorization": f"Basic {basic}"}
+
+
+def create_digest_auth(username: str, password: str):
+    # Digestしか受け付けないカメラ向け（aiohttp 3.12以降にある。無ければ使わない）
+    digest_cls = getattr(aiohttp, "DigestAuthMiddleware", None)
+    return digest_cls(username, password) if digest_cls is not None else None
+
+
+async def fetch_to_file(
+    session: aiohttp.ClientSession,
+    url: str,
+    path: Path,
+    chunk_size: int = 64 * 1024,
+    middlewares=(),
+    headers: Optional[dict] = None,
+) -> int:
+    # 受け取りながらファイルへ書く（画像全体をメモリに溜めない）。戻り値は書いたバイト数
+    kwargs = {"middlewares": tuple(middlewares)} if middlewares else {}
+    async with session.get(url, headers=headers, **kwargs) as resp:
+        resp.raise_for_status()
+        f = await asyncio.to_thread(path.open, "wb")
+        written = 0
+        try:
+            async for chunk in resp.content.iter_chunked(chunk_size):
+                written += await asyncio.to_thread(f.write, chunk)
+        finally:
+            await asyncio.to_thread(f.close)
+        return written
+
+
+def grab_frame_pyav(rtsp_url: str, timeout_sec: float) -> bytes:
+    # 単発ffmpegと同じく、ストリーム解析を最小限にして最初のフレームを早く出す
+    # キーフレーム1枚だけなのでソフトウェアデコード（HWACCEL はffmpegで取るときだけ効く）
+    options = {
+        "rtsp_transport": "tcp",
+        "probesize": "32",
+        "analyzeduration": "0",
+        "fflags": "nobuffer",
+        "flags": "low_delay",
+    }
+    with av.open(rtsp_url, options=options, timeout=timeout_sec) as container:
+        stream = container.streams.video[0]
+        # キーフレームだけデコードする（途中から受けたPフレームの崩れた絵を出さない）
+        stream.codec_context.skip_frame = "NONKEY"
+        frame = next(container.decode(stream))
+        if tj is not None:
+            return tj.encode(frame.to_ndarray(format="bgr24"), quality=90)
+        buf = io.BytesIO()
+        frame.to_image().save(buf, "JPEG", quality=90)
+        return buf.getvalue()
+
+
+async def capture_via_pyav(rtsp_url: str, timeout_sec: float = 10.0) -> bytes:
+    # デコードはブロッキングなのでスレッドに逃がす
+    return await asyncio.wait_for(
+        asyncio.to_thread(grab_frame_pyav, rtsp_url, timeout_sec),
+        timeout=timeout_sec + 1.0,
+    )
+
+
+@dataclass
+class SnapshotState:
+    # 起動中は変わらないものを覚えておき、撮影のたびに問い合わせない
+    get_snapshot: Optional[Callable] = None
+    uri: Optional[str] = None
+    # 最後にうまくいった撮影経路（"helper" / "snapshot_uri" / "rtsp"）
+    strategy: Optional[str] = None
+    # SnapshotUriに付けるBasic認証のヘッダ（URLに認証情報が入っていれば使わない）
+    basic_headers: Optional[dict] = None
+    # SnapshotUriがDigest認証を求めてきたら、以後はこれで取る
+    digest_auth: Optional[object] = None
+    use_digest: bool = False
+
+
+async def capture_photo(
+    media,
+    session: aiohttp.ClientSession,
+    pump: SnapshotPump,
+    state: SnapshotState,
+    profile_token: str,
+    out_path: Path,
+    keep_pump: bool = True,
+) -> Path:
+    """
+    1) cam.get_snapshot が使えれば試す
+    2) GetSnapshotUri が取れればHTTPで取る（Faultなら無視）
+    3) どっちもだめならRTSP(ffmpeg)で取る（最終手段。ffmpegは常駐させて使い回す）
+    一度うまくいった経路は覚えておき、次からはそれを最初に試す
+    取れた画像は out_path に書き、そのパスを返す（HTTPは受け取りながら書く）
+    keep_pump=False なら、止まっている常駐ffmpegは起こさずに単発で取る
+    """
+    # 1) helper
+    async def via_helper():
+        if state.get_snapshot is None:
+            return 0
+        data = await state.get_snapshot(profile_token)
+        return await write_file(out_path, data) if data else 0
+
+    # 2) SnapshotUri -> HTTP
+    async def via_snapshot_uri():
+        if state.uri is None:
+            snap = await media.GetSnapshotUri({"ProfileToken": profile_token})
+            state.uri = getattr(snap, "Uri", None) or getattr(snap, "URI", None)
+            # URLに認証情報が入っていればそちらを使う（Authorizationヘッダと一緒には送れない）
+            if state.uri and URL(state.uri).user is not None:
+                state.basic_headers = None
+        if not state.uri:
+            return 0
+        if state.use_digest:
+            return await fetch_to_file(session, state.uri, out_path, middlewares=(state.digest_auth,))
+        try:
+            return await fetch_to_file(session, state.uri, out_path, headers=state.basic_headers)
+        except aiohttp.ClientResponseError as e:
+            challenge = (e.headers or {}).get("WWW-Authenticate", "")
+            if e.status != 401 or state.digest_auth is None or "digest" not in challenge.lower():
+                raise
+        # Basicが通らずDigestを求められたら、Digestで取り直す（次からは最初からDigest）
+        state.use_digest = True
+        return await fetch_to_file(session, state.uri, out_path, middlewares=(state.digest_auth,))
+
+    async def grab_once():
+        if av is not None:
+            return await capture_via_pyav(pump.rtsp_url, timeout_sec=10.0)
+        return await capture_via_rtsp_ffmpeg(
+            pump.rtsp_url, timeout_sec=10.0, input_args=pump.input_args, codec=pump.codec
+        )
+
+    # 3) RTSP fallback（常駐ffmpegの最新フレーム。だめなら単発のffmpegで取る）
+    async def via_rtsp():
+        if not keep_pump and not pump.running:
+            data = await grab_once()
+            return await write_file(out_path, data) if data else 0
+        try:
+            data = await pump.grab(timeout_sec=10.0)
+        except Exception:
+            # 常駐側は供給元だけ止めて単発で取り、ライブ表示が見ていれば流し直す
+            await pump.stop_source()
+            try:
+                data = await grab_once()
+            finally:
+                try:
+                    await pump.resume()
+                except Exception:
+                    pass
+        return await write_file(out_path, data) if data else 0
+
+    strategies = {"helper": via_helper, "snapshot_uri": via_snapshot_uri, "rtsp": via_rtsp}
+
+    # 前回うまくいった経路を先に試す。失敗したら忘れて、いつもの順番で試し直す
+    order = list(strategies)
+    if state.strategy in strategies:
+        order.remove(state.strategy)
+        order.insert(0, state.strategy)
+
+    rtsp_error: Optional[Exception] = None
+    for name in order:
+        try:
+            written = await strategies[name]()
+        except Exception as e:
+            # 最後に見せるのはRTSPのエラー（ffmpegの出力が入っていて一番手がかりになる）
+            if name == "rtsp":
+                rtsp_error = e
+            written = 0
+        if written:
+            state.strategy = name
+            return out_path
+        # 書きかけ・空のファイルは残さない（消すのもスレッドで）
+        await asyncio.to_thread(out_path.unlink, missing_ok=True)
+        if name == state.strategy:
+            state.strategy = None
+
+    if rtsp_error is not None:
+        raise rtsp_error
+    raise RuntimeError("no snapshot source available")
+
+
+def photo_out_path(out_dir: Path) -> Path:
+    # 保存先のフォルダは起動時に作ってある
+    return unique_path(out_dir, "capture", "jpg")
+
+
+async def write_file(path: Path, data: bytes) -> int:
+    # 遅いSDカードや録画中でも、書き込みでイベントループを止めないようにスレッドへ逃がす
+    return await asyncio.to_thread(path.write_bytes, data)
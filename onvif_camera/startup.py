@@ -0,0 +1,181 @@
+"""
+起動時の準備（.envの読み込み・プロファイルと範囲・tiltの向き・キャッシュ）
+"""
+import asyncio
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Optional
+
+import onvif
+
+from .cache import load_startup_cache, save_cache
+from .ptz import (
+    PtzMover,
+    decide_tilt_up_sign_by_limit,
+    get_pos,
+    get_ranges,
+    maybe_await,
+    nudge_off_tilt_limit,
+    pick_ptz_tokens,
+)
+from .stream import profile_video_codec
+from .ui import ui_flush, ui_line
+
+
+@dataclass
+class PtzSettings:
+    # desk / ceiling（必要なら.envで変える）
+    mount_mode: str = "desk"
+    # 体感調整（.envで上書き可）
+    step: float = 0.10
+    margin: float = 0.02
+    settle: float = 0.12
+    probe: float = 0.12
+    pan_sign: float = -1.0
+    # UPキーのtiltの符号（+1 / -1）。決めておくと起動時の判定を飛ばせる
+    forced_tilt_up_sign: Optional[int] = None
+
+
+def load_ptz_settings() -> PtzSettings:
+    tilt_up_env = os.environ.get("PTZ_TILT_UP_SIGN", "").strip()
+    if tilt_up_env not in ("", "1", "+1", "-1"):
+        raise ValueError(f"PTZ_TILT_UP_SIGN must be 1 or -1 (got {tilt_up_env!r})")
+    return PtzSettings(
+        mount_mode=os.environ.get("MOUNT_MODE", "desk").strip().lower(),
+        step=float(os.environ.get("PTZ_STEP", "0.10")),
+        margin=float(os.environ.get("PTZ_MARGIN", "0.02")),
+        settle=float(os.environ.get("PTZ_SETTLE_SEC", "0.12")),
+        probe=float(os.environ.get("PTZ_PROBE", "0.12")),
+        pan_sign=float(os.environ.get("PAN_SIGN", "-1.0")),
+        forced_tilt_up_sign=int(tilt_up_env) if tilt_up_env else None,
+    )
+
+
+def create_camera(host: str, port: int, user: str, password: str):
+    wsdl_dir = f"{os.path.dirname(onvif.__file__)}/wsdl/"
+    return onvif.ONVIFCamera(host, port, user, password, wsdl_dir=wsdl_dir)
+
+
+@dataclass
+class Startup:
+    media: Any
+    ptz: Any
+    token: str
+    mover: PtzMover
+    # 前回の起動で調べた結果（使えないときは None）
+    cache: Optional[dict]
+    cache_file: Optional[Path]
+    tilt_forced: bool
+    # 映像のコーデック（GetProfilesか前回の起動で分かったもの。分からなければ None）
+    video_codec: Optional[str] = None
+
+    async def invert_tilt(self) -> int:
+        self.mover.tilt_up_sign *= -1
+        if self.cache is not None and not self.tilt_forced:
+            # 手で直した向きは次回の起動でも使う（.envで決めているときはそちらが優先なので触らない）
+            self.cache["tilt_up_sign"] *= -1
+            await save_cache(self.cache_file, self.cache)
+        return self.mover.tilt_up_sign
+
+    async def remember_snapshot_route(self, strategy: Optional[str], codec: Optional[str]):
+        # 経路やコーデックが変わったときだけ書き直す（調べられなかったコーデックは覚えない）
+        codec = codec or None
+        if self.cache is None:
+            return
+        if self.cache.get("snapshot_strategy") == strategy and self.cache.get("video_codec") == codec:
+            return
+        self.cache["snapshot_strategy"] = strategy
+        self.cache["video_codec"] = codec
+        await save_cache(self.cache_file, self.cache)
+
+
+async def resolve_startup(stdscr, cam, settings: PtzSettings, cache_file: Optional[Path]) -> Startup:
+    """
+    cam.update_xaddrs() のあとに呼ぶ。
+    戻り値の mover は天井付けの反転を入れたあとの符号で、今の位置も取ってある。
+    """
+    # 前回の起動で調べた結果があれば、プロファイル・範囲・tiltの向きは問い合わせない
+    # （読み込みとサービスの作成は互いに関係ないので同時に進める）
+    (device_key, cache), media, ptz = await asyncio.gather(
+        load_startup_cache(cam, cache_file),
+        maybe_await(cam.create_media_service()),
+        maybe_await(cam.create_ptz_service()),
+    )
+
+    start_pos = None
+    if cache is not None:
+        token = cache["token"]
+        pan_min, pan_max, tilt_min, tilt_max = cache["ranges"]
+        video_codec = cache.get("video_codec")
+    else:
+        profiles = await media.GetProfiles()
+        token, cfg_token = pick_ptz_tokens(profiles)
+        video_codec = profile_video_codec(profiles, token)
+        # 範囲と今の位置は別々に聞けるので同時に
+        (pan_min, pan_max, tilt_min, tilt_max), start_pos = await asyncio.gather(
+            get_ranges(ptz, cfg_token), get_pos(ptz, token)
+        )
+
+    ceiling = settings.mount_mode == "ceiling"
+    forced = settings.forced_tilt_up_sign
+
+    if forced is not None:
+        # .envで決めてあれば調べない（画面に出る値そのもの。天井付けの反転は下で打ち消される）
+        tilt_up_sign = forced * (-1 if ceiling else +1)
+    elif cache is not None and cache["tilt_up_sign"] is not None:
+        tilt_up_sign = cache["tilt_up_sign"]
+    else:
+        ui_line(stdscr, 0, "calibrating tilt ...")
+        ui_line(stdscr, 2, f"range pan[{pan_min:.2f},{pan_max:.2f}] tilt[{tilt_min:.2f},{tilt_max:.2f}]")
+        ui_flush(stdscr)
+
+        # 端に張り付いていたら少し中へ（判定外れ防止）
+        await nudge_off_tilt_limit(ptz, token, tilt_min, tilt_max, settle=settings.settle, p=start_pos)
+
+        # UPが tilt_max に近づく符号を自動決定
+        tilt_up_sign = await decide_tilt_up_sign_by_limit(
+            ptz, token, tilt_max, probe=settings.probe, settle=max(0.20, settings.settle)
+        )
+
+    if cache is None and device_key is not None:
+        # .envで決めた符号は調べた結果ではないので、プロファイルと範囲だけ覚えておく
+        cache = {
+            "device": device_key,
+            "token": token,
+            "ranges": [pan_min, pan_max, tilt_min, tilt_max],
+            "tilt_up_sign": None if forced is not None else tilt_up_sign,
+            "video_codec": video_codec,
+        }
+        await save_cache(cache_file, cache)
+    elif cache is not None and forced is None and cache["tilt_up_sign"] is None:
+        # 前回は.envで決めていて、今回はじめて調べた
+        cache["tilt_up_sign"] = tilt_up_sign
+        await save_cache(cache_file, cache)
+
+    # 天井付けは左右上下が反転しやすいのでここで反映
+    pan_sign = settings.pan_sign * (-1.0 if ceiling else 1.0)
+    if ceiling:
+        tilt_up_sign *= -1
+
+    mover = PtzMover(
+        ptz,
+        token,
+        (pan_min, pan_max, tilt_min, tilt_max),
+        margin=settings.margin,
+        step=settings.step,
+        settle=settings.settle,
+        pan_sign=pan_sign,
+        tilt_up_sign=tilt_up_sign,
+    )
+    await mover.sync()
+    return Startup(
+        media=media,
+        ptz=ptz,
+        token=token,
+        mover=mover,
+        cache=cache,
+        cache_file=cache_file,
+        tilt_forced=forced is not None,
+        video_codec=video_codec,
+    )
@@ -0,0 +1,445 @@
+"""
+RTSPとffmpeg（単発の取得・常駐させて最新フレームを持つ SnapshotPump・ライブ表示）
+"""
+import asyncio
+import os
+import shutil
+import signal
+import sys
+from typing import Optional
+
+
+def get_rtsp_url(host: str, username: str, password: str) -> str:
+    # だめなら .env の STREAM_URL で上書きできる
+    return f"rtsp://{username}:{password}@{host}:554/stream1"
+
+
+# ffmpegが使えるハードウェアデコードの一覧（起動中は変わらないので一度だけ調べる）
+_hwaccels: Optional[frozenset] = None
+
+
+async def ffmpeg_hwaccels() -> frozenset:
+    global _hwaccels
+    if _hwaccels is None:
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                "ffmpeg",
+                "-hide_banner",
+                "-hwaccels",
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL,
+            )
+            out, _ = await proc.communicate()
+            # 1行目は見出し（Hardware acceleration methods:）
+            lines = out.decode(errors="replace").splitlines()[1:]
+            _hwaccels = frozenset(line.strip() for line in lines if line.strip())
+        except OSError:
+            _hwaccels = frozenset()
+    return _hwaccels
+
+
+async def hwaccel_args(name: str) -> list:
+    # HWACCEL=cuda / vaapi / none。ffmpegが対応していなければソフトウェアデコードのまま
+    if name in ("", "none") or name not in await ffmpeg_hwaccels():
+        return []
+    return ["-hwaccel", name]
+
+
+def _signal_ffmpeg(proc, force: bool):
+    # POSIXでは start_new_session で起動しているので、プロセスグループごと止める
+    try:
+        if sys.platform != "win32":
+            os.killpg(proc.pid, signal.SIGKILL if force else signal.SIGTERM)
+        elif force:
+            proc.kill()
+        else:
+            proc.terminate()
+    except OSError:
+        # もう終わっている
+        pass
+
+
+async def stop_ffmpeg(proc, grace: float = 1.0, term_grace: float = 1.0):
+    """
+    ffmpeg に 'q' を送って終了させる（これが一番壊れにくい）
+    だめなら terminate -> kill
+    """
+    if proc.returncode is not None:
+        return
+    try:
+        if proc.stdin:
+            proc.stdin.write(b"q\n")
+            await proc.stdin.drain()
+    except Exception:
+        pass
+
+    try:
+        await asyncio.wait_for(proc.wait(), timeout=grace)
+        return
+    except asyncio.TimeoutError:
+        pass
+
+    _signal_ffmpeg(proc, force=False)
+    try:
+        await asyncio.wait_for(proc.wait(), timeout=term_grace)
+    except asyncio.TimeoutError:
+        _signal_ffmpeg(proc, force=True)
+        await proc.wait()
+
+
+# 撮影用のffmpegで -i の前に付ける。最初に来たSPS/PPSで決め打ちして、長いストリーム解析をしない（起動が速くなる）
+FAST_INPUT_ARGS = ("-probesize", "32", "-analyzeduration", "0", "-fflags", "nobuffer", "-flags", "low_delay")
+
+# ONVIFのVideoEncoderConfiguration.Encoding -> ffmpegのコーデック名
+_ONVIF_ENCODINGS = {"JPEG": "mjpeg", "H264": "h264", "H265": "hevc", "MPEG4": "mpeg4"}
+
+
+def profile_video_codec(profiles, token: str) -> Optional[str]:
+    # GetProfilesの結果から分かればffprobeを呼ばずに済む（分からなければ None）
+    for p in profiles:
+        if str(getattr(p, "token", "")) != token:
+            continue
+        cfg = getattr(p, "VideoEncoderConfiguration", None)
+        encoding = getattr(cfg, "Encoding", None) if cfg is not None else None
+        if encoding is None:
+            return None
+        return _ONVIF_ENCODINGS.get(str(encoding).upper(), str(encoding).lower())
+    return None
+
+
+async def probe_video_codec(rtsp_url: str, timeout_sec: float = 10.0) -> str:
+    # 映像のコーデック名（mjpeg / h264 など）。分からなければ空文字
+    # コーデック名はRTSPのSDPで分かるので、ストリームの中身はほとんど読まない
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            "ffprobe",
+            "-v", "quiet",
+            "-probesize", "32",
+            "-analyzeduration", "0",
+            "-rtsp_transport", "tcp",
+            "-select_streams", "v:0",
+            "-show_entries", "stream=codec_name",
+            "-of", "csv=p=0",
+            rtsp_url,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+            start_new_session=sys.platform != "win32",
+        )
+    except OSError:
+        return ""
+    try:
+        out, _ = await asyncio.wait_for(proc.communicate(), timeout=timeout_sec)
+    except asyncio.TimeoutError:
+        _signal_ffmpeg(proc, force=True)
+        await proc.wait()
+        return ""
+    return out.decode(errors="replace").strip().lower()
+
+
+def jpeg_output_args(codec: Optional[str]) -> list:
+    # 元がMJPEGなら作り直さずに、そのままJPEGとして切り出す
+    if codec == "mjpeg":
+        return ["-c:v", "copy", "-bsf:v", "mjpeg2jpeg"]
+    return ["-vcodec", "mjpeg", "-q:v", "2"]
+
+
+async def capture_via_rtsp_ffmpeg(
+    rtsp_url: str, timeout_sec: float = 10.0, input_args=(), codec: Optional[str] = None
+) -> bytes:
+    """
+    ffmpegでRTSPから1フレームをJPEGで取り出してbytesで返す
+    （一時ファイルは使わず、stdoutのパイプで受け取る）
+    """
+    # キーフレームだけデコードする（途中から受けたPフレームの崩れた絵を出さない）
+    # MJPEGをそのまま切り出すときはデコードしないので付けない
+    skip_args = [] if codec == "mjpeg" else ["-skip_frame", "nokey"]
+    cmd = [
+        "ffmpeg",
+        "-hide_banner",
+        "-loglevel",
+        "error",
+        *FAST_INPUT_ARGS,
+        *input_args,
+        *skip_args,
+        "-rtsp_transport", "tcp",
+        "-i", rtsp_url,
+        "-frames:v", "1",
+        *jpeg_output_args(codec),
+        "-f", "image2pipe",
+        "pipe:1",
+    ]
+
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        start_new_session=sys.platform != "win32",
+    )
+
+    # stdoutとstderrを同時に読むので、どちらかのパイプが詰まって止まることもない
+    # （stdinは止めるときに 'q' を送るので開けたまま。communicateだと閉じてしまう）
+    try:
+        data, err, _ = await asyncio.wait_for(
+            asyncio.gather(proc.stdout.read(), proc.stderr.read(), proc.wait()),
+            timeout=timeout_sec,
+        )
+    except asyncio.TimeoutError:
+        await stop_ffmpeg(proc)
+        raise RuntimeError("ffmpeg timeout while capturing frame")
+
+    if proc.returncode != 0:
+        err = err.decode("utf-8", errors="ignore")
+        err = err.strip().replace("\n", " ")
+        raise RuntimeError(f"ffmpeg failed (code={proc.returncode}): {err[:400]}")
+    if not data:
+        raise RuntimeError("ffmpeg returned no frame")
+
+    return data
+
+
+async def drain_stream(stream, limit: int = 4096) -> bytes:
+    # 読み捨てながら末尾 limit バイトだけ残す（パイプが詰まってffmpegが止まらないように）
+    tail = bytearray()
+    while chunk := await stream.read(4096):
+        tail.extend(chunk)
+        del tail[:-limit]
+    return bytes(tail)
+
+
+class SnapshotPump:
+    """
+    ffmpegを1本だけ常駐させて、RTSPからMJPEGを流し続けてもらう。
+    最新の1枚を持っておくので、2回目以降の撮影はRTSPの接続からやり直さずに済む。
+    録画中は録画用ffmpegのMJPEG出力に付け替えて、RTSPの接続を1本にまとめる。
+    """
+
+    def __init__(self, rtsp_url: str, input_args=()):
+        self.rtsp_url = rtsp_url
+        # -i の前に付けるffmpegのオプション（ハードウェアデコードなど）
+        self.input_args = list(input_args)
+        # 映像のコーデック（None なら最初の start で調べる。空文字は不明）
+        self.codec: Optional[str] = None
+        self._proc = None
+        self._owned = True
+        self._task: Optional[asyncio.Task] = None
+        self._latest: Optional[bytes] = None
+        # 届いたフレームの通し番号（grab が呼ばれた後の1枚を見分ける）
+        self._seq = 0
+        self._updated = asyncio.Event()
+        self._subscribers: set = set()
+        # 付け替えをやめた録画用ffmpegのstdoutを読み捨てるタスク
+        self._drains: set = set()
+
+    @property
+    def running(self) -> bool:
+        return self._proc is not None and self._proc.returncode is None
+
+    async def start(self):
+        if self.running:
+            return
+        if self.codec is None:
+            self.codec = await probe_video_codec(self.rtsp_url)
+        cmd = [
+            "ffmpeg",
+            "-hide_banner",
+            "-loglevel", "error",
+            *FAST_INPUT_ARGS,
+            *self.input_args,
+            "-rtsp_transport", "tcp",
+            # 映像が途切れたまま居座らないように、5秒読めなければ終わらせる（マイクロ秒）
+            "-rw_timeout", "5000000",
+            "-i", self.rtsp_url,
+            "-an",
+            *jpeg_output_args(self.codec),
+            "-f", "image2pipe",
+            "pipe:1",
+        ]
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        self._use(proc, owned=True)
+
+    def _use(self, proc, owned: bool):
+        self._proc = proc
+        self._owned = owned
+        self._latest = None
+        self._updated.clear()
+        self._task = asyncio.create_task(self._read_frames(proc.stdout))
+
+    async def attach(self, proc):
+        # 録画用ffmpegのstdout(MJPEG)をフレームの供給元にする。自前のffmpegは止める
+        await self._stop_source()
+        self._use(proc, owned=False)
+
+    async def release(self, proc):
+        # 録画が終わったら付け替えを戻す。ライブ表示中なら自前のffmpegですぐ再開する
+        if self._proc is not proc:
+            return
+        await self._stop_source()
+        await self.resume()
+
+    async def stop_source(self):
+        # 供給元のffmpegだけ止める。購読（ライブ表示など）は切らない
+        # （ffplayは -autoexit なので、stdinを閉じるとライブ表示まで終わってしまう）
+        await self._stop_source()
+
+    async def resume(self):
+        # 購読が残っていれば、自前のffmpegで流し直す
+        if self._subscribers:
+            await self.start()
+
+    async def _read_frames(self, stream):
+        buf = bytearray()
+        try:
+            while chunk := await stream.read(65536):
+                buf.extend(chunk)
+                # SOI(FFD8)からEOI(FFD9)までが1枚。完結している最後の1枚だけ残す
+                end = buf.rfind(b"\xff\xd9")
+                if end < 0:
+                    if len(buf) > 16 * 1024 * 1024:
+                        buf.clear()
+                    continue
+                start = buf.rfind(b"\xff\xd8", 0, end)
+                if start >= 0:
+                    self._latest = bytes(buf[start : end + 2])
+                    self._seq += 1
+                    self._updated.set()
+                    self._publish(self._latest)
+                del buf[: end + 2]
+        finally:
+            # 待っている側を起こす（終了したことは running で分かる）
+            self._updated.set()
+
+    def subscribe(self, writer: asyncio.StreamWriter):
+        # ライブ表示など、同じフレームを流してほしい相手（ffplayのstdinなど）を登録する
+        self._subscribers.add(writer)
+
+    def _publish(self, frame: bytes):
+        for writer in list(self._subscribers):
+            if writer.is_closing():
+                self._subscribers.discard(writer)
+                continue
+            # 相手が追いつかないときは溜めずにそのフレームを捨てる
+            if writer.transport.get_write_buffer_size() > 2 * len(frame):
+                continue
+            writer.write(frame)
+
+    async def grab(self, timeout_sec: float = 10.0) -> bytes:
+        await self.start()
+        # 呼ばれた後に届いた1枚を返す（止まったストリームの古い絵を黙って保存しないように）
+        # 常駐していれば待つのは1フレーム分だけ
+        seq = self._seq
+        async with asyncio.timeout(timeout_sec):
+            while self._seq == seq:
+                if self._task is None or self._task.done():
+                    raise RuntimeError("ffmpeg snapshot stream ended")
+                self._updated.clear()
+                await self._updated.wait()
+        return self._latest
+
+    async def _stop_source(self):
+        proc, task, owned = self._proc, self._task, self._owned
+        self._proc = None
+        self._task = None
+        self._latest = None
+        if not owned:
+            # 録画用ffmpegは stop_recording が止めるので、ここでは止めない。
+            # ただしstdoutを放っておくとパイプが詰まって録画まで止まるので、最後まで読み捨てる
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+            if proc is not None and proc.returncode is None:
+                drain = asyncio.create_task(drain_stream(proc.stdout))
+                self._drains.add(drain)
+                drain.add_done_callback(self._drains.discard)
+            return
+        if proc is not None and proc.returncode is None:
+            await stop_live_preview(proc)
+        if task is not None:
+            await task
+
+    async def stop(self):
+        # 購読側にはEOFを渡して終わってもらう
+        for writer in self._subscribers:
+            writer.close()
+        self._subscribers.clear()
+        await self._stop_source()
+
+
+async def start_live_preview(rtsp_url: str, pump: Optional[SnapshotPump] = None):
+    if shutil.which("ffplay") is None:
+        raise RuntimeError("ffplay not found")
+
+    if pump is not None and pump.running:
+        # 常駐ffmpegが動いていればそのMJPEGをstdinで受け取る（カメラへRTSPをもう1本張らず、デコードも1回で済む）
+        # 動いていなければ、ライブ表示のためだけに起こさずffplayで直接つなぐ
+        cmd = [
+            "ffplay",
+            "-hide_banner",
+            "-loglevel",
+            "error",
+            "-fflags",
+            "nobuffer",
+            "-flags",
+            "low_delay",
+            "-framedrop",
+            "-autoexit",
+            "-window_title",
+            "ONVIF Live Preview",
+            "-f",
+            "mjpeg",
+            "pipe:0",
+        ]
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        pump.subscribe(proc.stdin)
+        return proc
+
+    cmd = [
+        "ffplay",
+        "-hide_banner",
+        "-loglevel",
+        "error",
+        "-rtsp_transport",
+        "tcp",
+        "-fflags",
+        "nobuffer",
+        "-flags",
+        "low_delay",
+        "-framedrop",
+        "-window_title",
+        "ONVIF Live Preview",
+        rtsp_url,
+    ]
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.DEVNULL,
+    )
+    return proc
+
+
+async def stop_live_preview(proc):
+    try:
+        proc.terminate()
+    except Exception:
+        pass
+
+    try:
+        await asyncio.wait_for(proc.wait(), timeout=1.5)
+    except asyncio.TimeoutError:
+        try:
+            proc.kill()
+        except Exception:
+            pass
+        await proc.wait()
@@ -0,0 +1,151 @@
+"""
+cursesの画面表示とキー入力
+"""
+import asyncio
+import curses
+import sys
+from typing import Optional, Tuple
+
+
+# 移動キー -> 向き（押しっぱなしのキーをまとめるときに使う）
+MOVE_KEYS = {
+    curses.KEY_RIGHT: "right",
+    ord("d"): "right",
+    ord("D"): "right",
+    curses.KEY_LEFT: "left",
+    ord("a"): "left",
+    ord("A"): "left",
+    curses.KEY_UP: "up",
+    ord("w"): "up",
+    ord("W"): "up",
+    curses.KEY_DOWN: "down",
+    ord("s"): "down",
+    ord("S"): "down",
+}
+
+
+# 行ごとに最後に書いた内容を覚えておき、変わった行だけ書き直す
+_ui_rows: dict = {}
+_ui_dirty = False
+# 端末の幅（ループ1周ごとに測り直す。0なら次のui_lineで測る）
+_ui_width = 0
+
+
+def setup_screen(stdscr):
+    curses.curs_set(0)
+    # 矢印キーはESCから始まる並びなので、ESC単体かどうかの待ちを短くする
+    # （0にすると遅い回線で並びが途中で切れて、矢印キーがESCと文字に化ける）
+    if hasattr(curses, "set_escdelay"):
+        curses.set_escdelay(25)
+    stdscr.nodelay(False)
+    stdscr.keypad(True)
+
+
+def ui_line(stdscr, row: int, text: str):
+    global _ui_dirty, _ui_width
+    if not _ui_width:
+        _ui_width = stdscr.getmaxyx()[1]
+    text = text[: _ui_width - 1]
+    if _ui_rows.get(row) == text:
+        return
+    _ui_rows[row] = text
+    _ui_dirty = True
+    # 書いてから行末まで消す（全角文字があっても前の内容のゴミが残らないように）
+    stdscr.addstr(row, 0, text)
+    stdscr.clrtoeol()
+
+
+def ui_clear(stdscr):
+    global _ui_dirty
+    _ui_rows.clear()
+    _ui_dirty = True
+    stdscr.clear()
+
+
+def ui_flush(stdscr):
+    # 変更があるときだけ、まとめて端末へ書き出す
+    global _ui_dirty, _ui_width
+    _ui_width = 0
+    if not _ui_dirty:
+        return
+    _ui_dirty = False
+    stdscr.noutrefresh()
+    curses.doupdate()
+
+
+_key_poll_task: Optional[asyncio.Task] = None
+
+
+def start_key_reader(stdscr, key_queue: asyncio.Queue):
+    # 端末が読めるようになったら、cursesに溜まっているキーをキューへ移す
+    # （getchで待たないので、待っている間も他のタスクが動ける）
+    global _key_poll_task
+
+    def on_readable():
+        while (k := stdscr.getch()) != -1:
+            key_queue.put_nowait(k)
+
+    stdscr.nodelay(True)
+    try:
+        asyncio.get_running_loop().add_reader(sys.stdin.fileno(), on_readable)
+    except NotImplementedError:
+        # add_readerが無いループ（WindowsのProactorなど）では短い間隔で見に行く
+        # cursesは別スレッドから触ると壊れやすいので、スレッドは使わない
+        _key_poll_task = asyncio.create_task(poll_keys(on_readable))
+
+
+async def poll_keys(on_readable, interval: float = 0.02):
+    while True:
+        on_readable()
+        await asyncio.sleep(interval)
+
+
+def stop_key_reader(stdscr):
+    global _key_poll_task
+    if _key_poll_task is not None:
+        _key_poll_task.cancel()
+        _key_poll_task = None
+    else:
+        try:
+            asyncio.get_running_loop().remove_reader(sys.stdin.fileno())
+        except NotImplementedError:
+            pass
+    stdscr.nodelay(False)
+
+
+async def next_key(key_queue: asyncio.Queue, timeout: Optional[float] = None) -> int:
+    # timeout までにキーが来なければ -1
+    try:
+        return await asyncio.wait_for(key_queue.get(), timeout=timeout)
+    except asyncio.TimeoutError:
+        return -1
+
+
+def take_repeats(key_queue: asyncio.Queue, direction: str) -> Tuple[int, Optional[int]]:
+    # 押しっぱなしで溜まった同じ向きのキーを数える（まとめて1回のRelativeMoveにする）
+    # 違うキーが来たらそこで止めて、そのキーを返す（次のループで先に処理する）
+    repeat = 1
+    while not key_queue.empty():
+        k = key_queue.get_nowait()
+        if k == -1:
+            continue
+        if MOVE_KEYS.get(k) != direction:
+            return repeat, k
+        repeat += 1
+    return repeat, None
+
+
+async def watch_exit(proc, key_queue: asyncio.Queue):
+    # プロセスが終わったら -1 を入れて、メインループに表示を更新させる
+    await proc.wait()
+    key_queue.put_nowait(-1)
+
+
+# 動いている watch_exit のタスク（ループは弱い参照しか持たないので、終わるまでここで持つ）
+_watch_tasks: set = set()
+
+
+def start_exit_watch(proc, key_queue: asyncio.Queue):
+    task = asyncio.create_task(watch_exit(proc, key_queue))
+    _watch_tasks.add(task)
+    task.add_done_callback(_watch_tasks.discard)
@@ -2,232 +2,37 @@
 import asyncio
 import curses
 import os
-import shutil
-import time
-from typing import Optional, Tuple
+import sys
 
-import onvif
 from dotenv import load_dotenv
 
-
-# -----------------------
-# helpers
-# -----------------------
-async def maybe_await(x):
-    return await x if asyncio.iscoroutine(x) else x
-
-
-def safe_get(obj, path: str, default=None):
-    cur = obj
-    for key in path.split("."):
-        if cur is None:
-            return default
-        cur = getattr(cur, key, None)
-    return default if cur is None else cur
-
-
-def clamp(v, lo, hi):
-    return lo if v < lo else hi if v > hi else v
-
-
-def pick_ptz_profile(profiles):
-    for p in profiles:
-        if getattr(p, "PTZConfiguration", None):
-            return p
-    return profiles[0]
+from onvif_camera.cache import cache_path
+from onvif_camera.ptz import goto_home
+from onvif_camera.startup import create_camera, load_ptz_settings, resolve_startup
+from onvif_camera.stream import get_rtsp_url, start_live_preview, stop_live_preview
+from onvif_camera.ui import (
+    MOVE_KEYS,
+    next_key,
+    setup_screen,
+    start_exit_watch,
+    start_key_reader,
+    stop_key_reader,
+    take_repeats,
+    ui_clear,
+    ui_flush,
+    ui_line,
+)
+
+try:
+    # uvloop（任意）
+    import uvloop
+except ImportError:
+    uvloop = None
 
 
 # -----------------------
-# ONVIF operations
+# main
 # -----------------------
-async def get_pos(ptz, token) -> Optional[Tuple[float, float]]:
-    st = await ptz.GetStatus({"ProfileToken": token})
-    x = safe_get(st, "Position.PanTilt.x", None)
-    y = safe_get(st, "Position.PanTilt.y", None)
-    if x is None or y is None:
-        return None
-    return float(x), float(y)
-
-
-async def goto_home(ptz, token) -> bool:
-    try:
-        req = ptz.create_type("GotoHomePosition")
-        req.ProfileToken = token
-        await ptz.GotoHomePosition(req)
-        return True
-    except Exception:
-        return False
-
-
-async def relative_move(ptz, token, dx: float, dy: float):
-    """
-    Tapo系は create_type("RelativeMove") でネストが None のままだと
-    嫌がることがあるので、辞書で“全部埋めて”送ります。
-    """
-    await ptz.RelativeMove(
-        {
-            "ProfileToken": token,
-            "Translation": {"PanTilt": {"x": dx, "y": dy}},
-        }
-    )
-
-
-async def start_live_preview(rtsp_url: str):
-    if shutil.which("ffplay") is None:
-        raise RuntimeError("ffplay not found")
-
-    cmd = [
-        "ffplay",
-        "-hide_banner",
-        "-loglevel",
-        "error",
-        "-rtsp_transport",
-        "tcp",
-        "-fflags",
-        "nobuffer",
-        "-flags",
-        "low_delay",
-        "-framedrop",
-        "-window_title",
-        "ONVIF Live Preview",
-        rtsp_url,
-    ]
-    proc = await asyncio.create_subprocess_exec(
-        *cmd,
-        stdin=asyncio.subprocess.DEVNULL,
-        stdout=asyncio.subprocess.DEVNULL,
-        stderr=asyncio.subprocess.DEVNULL,
-    )
-    return proc
-
-
-async def stop_live_preview(proc):
-    try:
-        proc.terminate()
-    except Exception:
-        pass
-
-    try:
-        await asyncio.wait_for(proc.wait(), timeout=1.5)
-    except asyncio.TimeoutError:
-        try:
-            proc.kill()
-        except Exception:
-            pass
-        await proc.wait()
-
-
-async def get_ranges(ptz, cfg_token) -> Tuple[float, float, float, float]:
-    """
-    あなたの出力どおり、-1..+1 が取れる前提。
-    取れなくても -1..+1 にフォールバック。
-    """
-    req = ptz.create_type("GetConfigurationOptions")
-    req.ConfigurationToken = cfg_token
-    opts = await ptz.GetConfigurationOptions(req)
-    spaces = getattr(opts, "Spaces", None)
-
-    abs_space = getattr(spaces, "AbsolutePanTiltPositionSpace", None) if spaces else None
-    if abs_space:
-        xr = abs_space[0].XRange
-        yr = abs_space[0].YRange
-        pan_min = float(getattr(xr, "Min", -1.0))
-        pan_max = float(getattr(xr, "Max", 1.0))
-        tilt_min = float(getattr(yr, "Min", -1.0))
-        tilt_max = float(getattr(yr, "Max", 1.0))
-        return pan_min, pan_max, tilt_min, tilt_max
-
-    return -1.0, 1.0, -1.0, 1.0
-
-
-# -----------------------
-# tilt auto calibration
-# -----------------------
-async def nudge_off_tilt_limit(ptz, token, tilt_min, tilt_max, settle: float):
-    """
-    tilt が端に張り付いてると判定が外れやすいので、少しだけ中へ寄せます。
-    """
-    p = await get_pos(ptz, token)
-    if p is None:
-        return
-    _, y = p
-    eps = 0.01
-
-    if y >= tilt_max - eps:
-        # 上限に張り付き → 少し下へ（符号は未確定なので両方試す）
-        try:
-            await relative_move(ptz, token, 0.0, -0.12)
-            await asyncio.sleep(settle)
-        except Exception:
-            pass
-    elif y <= tilt_min + eps:
-        # 下限に張り付き → 少し上へ（符号は未確定なので両方試す）
-        try:
-            await relative_move(ptz, token, 0.0, +0.12)
-            await asyncio.sleep(settle)
-        except Exception:
-            pass
-
-
-async def decide_tilt_up_sign_by_limit(
-    ptz, token, tilt_max: float, probe: float = 0.12, settle: float = 0.25
-) -> int:
-    """
-    「UPキー＝tilt を tilt_max 側へ近づける」と定義して、
-    dy=+probe / dy=-probe のどっちが tilt_max に近づくかで決めます。
-
-    return:
-      +1 -> UPキーで dy=+step
-      -1 -> UPキーで dy=-step
-    """
-    p0 = await get_pos(ptz, token)
-    if p0 is None:
-        return +1
-    _, y0 = p0
-
-    async def try_dy(dy):
-        try:
-            await relative_move(ptz, token, 0.0, dy)
-            await asyncio.sleep(settle)
-            p = await get_pos(ptz, token)
-            return None if p is None else float(p[1])
-        except Exception:
-            return None
-
-    # +probe を試す
-    y_plus = await try_dy(+probe)
-    # だいたい戻す
-    await try_dy(-probe)
-    # -probe を試す
-    y_minus = await try_dy(-probe)
-    # だいたい戻す
-    await try_dy(+probe)
-
-    if y_plus is None or y_minus is None:
-        # 取れない/失敗したら、手動反転 i に任せる（まずは +1）
-        return +1
-
-    # “tilt_max に近い方” を UP に採用
-    dist_plus = abs(tilt_max - y_plus)
-    dist_minus = abs(tilt_max - y_minus)
-
-    # 変化が全くないなら、どっちでも同じ → +1
-    if abs(y_plus - y0) < 1e-3 and abs(y_minus - y0) < 1e-3:
-        return +1
-
-    return +1 if dist_plus <= dist_minus else -1
-
-
-# -----------------------
-# UI
-# -----------------------
-def ui_line(stdscr, row: int, text: str):
-    # 行を消してから書く（ゴミが残らないように）
-    h, w = stdscr.getmaxyx()
-    stdscr.addstr(row, 0, " " * (w - 1))
-    stdscr.addstr(row, 0, text[: w - 1])
-
-
 async def async_main(stdscr):
     load_dotenv()
 
@@ -236,201 +41,123 @@ async def async_main(stdscr):
     user = os.environ["ONVIF_USER"]
     password = os.environ["ONVIF_PASSWORD"]
 
-    # desk / ceiling（必要なら.envで変える）
-    mount_mode = os.environ.get("MOUNT_MODE", "desk").strip().lower()
-
-    # 体感調整（.envで上書き可）
-    step = float(os.environ.get("PTZ_STEP", "0.10"))
-    margin = float(os.environ.get("PTZ_MARGIN", "0.02"))
-    settle = float(os.environ.get("PTZ_SETTLE_SEC", "0.12"))
-    probe = float(os.environ.get("PTZ_PROBE", "0.12"))
-    pan_sign_base = float(os.environ.get("PAN_SIGN", "-1.0"))
-
-    curses.curs_set(0)
-    stdscr.nodelay(False)
-    stdscr.keypad(True)
+    settings = load_ptz_settings()
+    cache_file = cache_path(host)
+    # RTSPのURLは起動中に変わらないので一度だけ組み立てる
+    rtsp_url = os.environ.get("STREAM_URL") or get_rtsp_url(host, user, password)
 
-    wsdl_dir = f"{os.path.dirname(onvif.__file__)}/wsdl/"
-    cam = onvif.ONVIFCamera(host, port, user, password, wsdl_dir=wsdl_dir)
+    setup_screen(stdscr)
+    cam = create_camera(host, port, user, password)
 
-    ptz = None
-    token = None
     live_proc = None
 
-    # 反転（ユーザー視点）
-    pan_sign = pan_sign_base
-    tilt_up_sign = +1  # 起動時に決め直す
-
     try:
         ui_line(stdscr, 0, "connecting ...")
-        stdscr.refresh()
+        ui_flush(stdscr)
 
         await cam.update_xaddrs()
+        st = await resolve_startup(stdscr, cam, settings, cache_file)
+        mover = st.mover
 
-        media = await maybe_await(cam.create_media_service())
-        profiles = await media.GetProfiles()
-        profile = pick_ptz_profile(profiles)
-        token = profile.token
-
-        ptz = await maybe_await(cam.create_ptz_service())
-
-        pan_min, pan_max, tilt_min, tilt_max = await get_ranges(ptz, profile.PTZConfiguration.token)
-
-        # 天井付けは左右上下が反転しやすいのでここで反映
-        if mount_mode == "ceiling":
-            pan_sign *= -1.0
-
-        ui_line(stdscr, 0, "calibrating tilt ...")
-        ui_line(stdscr, 2, f"range pan[{pan_min:.2f},{pan_max:.2f}] tilt[{tilt_min:.2f},{tilt_max:.2f}]")
-        stdscr.refresh()
-
-        # 端に張り付いていたら少し中へ（判定外れ防止）
-        await nudge_off_tilt_limit(ptz, token, tilt_min, tilt_max, settle=settle)
-
-        # ここが本題：UPが tilt_max に近づく符号を自動決定
-        tilt_up_sign = await decide_tilt_up_sign_by_limit(ptz, token, tilt_max, probe=probe, settle=max(0.20, settle))
-
-        # 天井付けなら上下も反転
-        if mount_mode == "ceiling":
-            tilt_up_sign *= -1
-
-        pos = await get_pos(ptz, token)
-
-        stdscr.clear()
+        ui_clear(stdscr)
         ui_line(stdscr, 0, "PTZ keyboard control (RelativeMove + tilt auto-fix)")
         ui_line(stdscr, 2, "Arrow / WASD : move")
         ui_line(stdscr, 4, "h            : go home (if supported)")
         ui_line(stdscr, 5, "i            : invert tilt (UP/DOWN swap)")
         ui_line(stdscr, 6, "l            : start/stop live preview")
         ui_line(stdscr, 7, "q            : quit")
-        ui_line(stdscr, 8, f"step={step} margin={margin} settle={settle} mount={mount_mode}")
-        ui_line(stdscr, 9, f"range pan[{pan_min:.2f},{pan_max:.2f}] tilt[{tilt_min:.2f},{tilt_max:.2f}]")
-        ui_line(stdscr, 10, f"tilt_up_sign={tilt_up_sign:+d}")
-        stdscr.refresh()
+        ui_line(stdscr, 8, f"step={settings.step} margin={settings.margin} settle={settings.settle} mount={settings.mount_mode}")
+        ui_line(stdscr, 9, f"range pan[{mover.pan_min:.2f},{mover.pan_max:.2f}] tilt[{mover.tilt_min:.2f},{mover.tilt_max:.2f}]")
+        ui_line(stdscr, 10, f"tilt_up_sign={mover.tilt_up_sign:+d}")
+        ui_flush(stdscr)
+
+        key_queue: asyncio.Queue = asyncio.Queue()
+        start_key_reader(stdscr, key_queue)
+        pending_key = None
 
         while True:
             if live_proc is not None and live_proc.returncode is not None:
                 live_proc = None
                 ui_line(stdscr, 14, "live preview stopped")
 
-            if pos is not None:
-                x, y = pos
+            if mover.pos is not None:
+                x, y = mover.pos
                 ui_line(stdscr, 12, f"pos pan={x:+.3f} tilt={y:+.3f}")
             else:
                 ui_line(stdscr, 12, "pos (not available)")
             ui_line(stdscr, 11, "live: on" if live_proc is not None else "live: off")
-            stdscr.refresh()
+            ui_flush(stdscr)
 
-            key = stdscr.getch()
+            if pending_key is not None:
+                key, pending_key = pending_key, None
+            else:
+                key = await next_key(key_queue, mover.idle_timeout)
+            if key == -1:
+                await mover.idle_sync()
+                continue
 
             if key in (ord("q"), ord("Q")):
                 break
 
             if key in (ord("h"), ord("H")):
-                ok = await goto_home(ptz, token)
+                ok = await goto_home(st.ptz, st.token)
                 ui_line(stdscr, 14, "home: ok" if ok else "home: not supported / failed")
-                stdscr.refresh()
+                ui_flush(stdscr)
                 await asyncio.sleep(0.4)
-                pos = await get_pos(ptz, token)
+                await mover.sync()
                 continue
 
             if key in (ord("i"), ord("I")):
-                tilt_up_sign *= -1
+                tilt_up_sign = await st.invert_tilt()
                 ui_line(stdscr, 10, f"tilt_up_sign={tilt_up_sign:+d}")
                 ui_line(stdscr, 14, "tilt inverted")
-                stdscr.refresh()
+                await mover.sync()
                 continue
 
             if key in (ord("l"), ord("L")):
-                rtsp_url = os.environ.get("STREAM_URL") or f"rtsp://{user}:{password}@{host}:554/stream1"
                 if live_proc is None:
                     ui_line(stdscr, 14, "live preview starting ...")
-                    stdscr.refresh()
+                    ui_flush(stdscr)
                     try:
                         live_proc = await start_live_preview(rtsp_url)
+                        start_exit_watch(live_proc, key_queue)
                         ui_line(stdscr, 14, "live preview started")
                     except Exception as e:
                         live_proc = None
                         ui_line(stdscr, 14, f"live preview failed: {type(e).__name__}: {e}")
                 else:
                     ui_line(stdscr, 14, "live preview stopping ...")
-                    stdscr.refresh()
+                    ui_flush(stdscr)
                     await stop_live_preview(live_proc)
                     live_proc = None
                     ui_line(stdscr, 14, "live preview stopped")
-                stdscr.refresh()
                 continue
 
-            dx = 0.0
-            dy = 0.0
-            msg = ""
-
-            # 端ガード（posが取れるときだけ）
-            # 注意：ここは “ユーザー視点” ではなく “ONVIF値の範囲” で止めます
-            if pos is not None:
-                x, y = pos
-                pan_lo = pan_min + margin
-                pan_hi = pan_max - margin
-                tilt_lo = tilt_min + margin
-                tilt_hi = tilt_max - margin
-            else:
-                # 取れないならガード無し
-                pan_lo, pan_hi, tilt_lo, tilt_hi = pan_min, pan_max, tilt_min, tilt_max
-
-            if key in (curses.KEY_RIGHT, ord("d"), ord("D")):
-                if pos is not None and x >= pan_hi:
-                    msg = "blocked: right limit"
-                else:
-                    dx = +step * pan_sign
-
-            elif key in (curses.KEY_LEFT, ord("a"), ord("A")):
-                if pos is not None and x <= pan_lo:
-                    msg = "blocked: left limit"
-                else:
-                    dx = -step * pan_sign
-
-            elif key in (curses.KEY_UP, ord("w"), ord("W")):
-                # UP = tilt_max 側へ近づく
-                # tilt_up_sign がその符号になっている
-                if pos is not None and y >= tilt_hi and tilt_up_sign > 0:
-                    msg = "blocked: up limit"
-                elif pos is not None and y <= tilt_lo and tilt_up_sign < 0:
-                    msg = "blocked: up limit"
-                else:
-                    dy = +step * tilt_up_sign
-
-            elif key in (curses.KEY_DOWN, ord("s"), ord("S")):
-                # DOWN は UP の反対
-                down_sign = -tilt_up_sign
-                if pos is not None and y >= tilt_hi and down_sign > 0:
-                    msg = "blocked: down limit"
-                elif pos is not None and y <= tilt_lo and down_sign < 0:
-                    msg = "blocked: down limit"
-                else:
-                    dy = +step * down_sign
-
-            if dx != 0.0 or dy != 0.0:
-                try:
-                    await relative_move(ptz, token, dx, dy)
-                    await asyncio.sleep(settle)
-                except Exception as e:
-                    msg = f"error: {type(e).__name__}"
-
+            # 押しっぱなしで溜まった同じ向きのキーは、まとめて1回のRelativeMoveにする
+            direction = MOVE_KEYS.get(key)
+            if direction is None:
+                continue
+            repeat, pending_key = take_repeats(key_queue, direction)
+            msg = await mover.move(direction, repeat)
             ui_line(stdscr, 14, msg)
-            stdscr.refresh()
-
-            pos = await get_pos(ptz, token)
+            ui_flush(stdscr)
+            await mover.settle()
 
     except Exception as e:
         # curses画面でも“何が起きたか”を見えるようにする
-        stdscr.clear()
+        ui_clear(stdscr)
         ui_line(stdscr, 0, "ERROR")
         ui_line(stdscr, 2, f"{type(e).__name__}: {e}")
         ui_line(stdscr, 4, "press any key to exit")
-        stdscr.refresh()
+        ui_flush(stdscr)
+        stop_key_reader(stdscr)
         stdscr.getch()
         raise
     finally:
+        try:
+            stop_key_reader(stdscr)
+        except Exception:
+            pass
         if live_proc is not None:
             try:
                 await stop_live_preview(live_proc)
@@ -443,7 +170,11 @@ async def async_main(stdscr):
 
 
 def main():
-    curses.wrapper(lambda stdscr: asyncio.run(async_main(stdscr)))
+    # uvloopが入っていればイベントループを差し替える（Windowsは対象外）
+    loop_factory = None
+    if uvloop is not None and sys.platform != "win32":
+        loop_factory = uvloop.new_event_loop
+    curses.wrapper(lambda stdscr: asyncio.run(async_main(stdscr), loop_factory=loop_factory))
 
 
 if __name__ == "__main__":
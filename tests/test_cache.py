@@ -0,0 +1,45 @@
+import json
+
+from onvif_camera.cache import _read_cache
+
+DEVICE = "Maker/Model/SN1"
+
+
+def write(path, data):
+    path.write_text(json.dumps(data), encoding="utf-8")
+    return path
+
+
+def test_read_cache_valid(tmp_path):
+    path = write(
+        tmp_path / "c.json",
+        {"device": DEVICE, "token": 1, "ranges": ["-1", 1, -0.5, 0.5], "tilt_up_sign": -3, "snapshot_strategy": "rtsp"},
+    )
+    cache = _read_cache(path, DEVICE)
+    assert cache["token"] == "1"
+    assert cache["ranges"] == [-1.0, 1.0, -0.5, 0.5]
+    assert cache["tilt_up_sign"] == -1
+    # ほかのスクリプトが書いた項目も残る
+    assert cache["snapshot_strategy"] == "rtsp"
+
+
+def test_read_cache_other_device(tmp_path):
+    path = write(tmp_path / "c.json", {"device": "Other/Model/SN2", "token": "t", "ranges": [-1, 1, -1, 1], "tilt_up_sign": 1})
+    assert _read_cache(path, DEVICE) is None
+
+
+def test_read_cache_missing_or_corrupt(tmp_path):
+    assert _read_cache(tmp_path / "none.json", DEVICE) is None
+    broken = tmp_path / "broken.json"
+    broken.write_text("{not json", encoding="utf-8")
+    assert _read_cache(broken, DEVICE) is None
+    short = write(tmp_path / "short.json", {"device": DEVICE, "token": "t", "ranges": [-1, 1]})
+    assert _read_cache(short, DEVICE) is None
+
+
+def test_read_cache_without_tilt_sign_needs_probe(tmp_path):
+    # PTZ_TILT_UP_SIGN を決めていた起動のキャッシュ
+    path = write(tmp_path / "c.json", {"device": DEVICE, "token": "t", "ranges": [-1, 1, -1, 1], "tilt_up_sign": None})
+    assert _read_cache(path, DEVICE)["tilt_up_sign"] is None
+    path = write(tmp_path / "c.json", {"device": DEVICE, "token": "t", "ranges": [-1, 1, -1, 1]})
+    assert _read_cache(path, DEVICE)["tilt_up_sign"] is None
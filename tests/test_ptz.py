@@ -0,0 +1,93 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from onvif_camera.ptz import MAX_MOVE_REPEAT, PtzMover, clamp_delta, pick_ptz_tokens
+
+
+@pytest.mark.parametrize(
+    "cur, d, expected",
+    [
+        (0.0, 0.3, 0.3),
+        (0.9, 0.3, 0.08),  # 上限の手前で止める
+        (0.99, 0.1, 0.0),  # もう上限を越えている
+        (-0.9, -0.3, -0.08),
+        (0.0, -2.0, -0.98),
+        (0.5, 0.0, 0.0),
+    ],
+)
+def test_clamp_delta(cur, d, expected):
+    assert clamp_delta(cur, d, -0.98, 0.98) == pytest.approx(expected)
+
+
+def test_pick_ptz_tokens_prefers_profile_with_ptz():
+    profiles = [
+        SimpleNamespace(token="main", PTZConfiguration=None),
+        SimpleNamespace(token="sub", PTZConfiguration=SimpleNamespace(token=7)),
+    ]
+    assert pick_ptz_tokens(profiles) == ("sub", "7")
+
+
+def test_pick_ptz_tokens_without_ptz():
+    profiles = [SimpleNamespace(token="main"), SimpleNamespace(token="sub")]
+    assert pick_ptz_tokens(profiles) == ("main", None)
+
+
+class FakePtz:
+    def __init__(self, x=0.0, y=0.0):
+        self.x = x
+        self.y = y
+        self.moves = []
+
+    async def GetStatus(self, req):
+        return SimpleNamespace(Position=SimpleNamespace(PanTilt=SimpleNamespace(x=self.x, y=self.y)))
+
+    async def RelativeMove(self, req):
+        t = req["Translation"]["PanTilt"]
+        self.moves.append((t["x"], t["y"]))
+
+
+def make_mover(ptz, step=0.1):
+    return PtzMover(ptz, "tok", (-1.0, 1.0, -1.0, 1.0), margin=0.02, step=step, settle=0.0, pan_sign=1.0, tilt_up_sign=1)
+
+
+def test_mover_blocks_at_limit():
+    async def run():
+        ptz = FakePtz(x=0.99)
+        mover = make_mover(ptz)
+        await mover.sync()
+        msg = await mover.move("right")
+        await mover.settle()
+        return ptz, msg
+
+    ptz, msg = asyncio.run(run())
+    assert msg == "blocked: right limit"
+    assert ptz.moves == []
+
+
+def test_mover_estimates_position_after_move():
+    async def run():
+        ptz = FakePtz()
+        mover = make_mover(ptz)
+        await mover.sync()
+        await mover.move("up", repeat=2)
+        await mover.settle()
+        return ptz, mover
+
+    ptz, mover = asyncio.run(run())
+    assert ptz.moves == [(0.0, pytest.approx(0.2))]
+    assert mover.pos == (0.0, pytest.approx(0.2))
+    assert mover.moves_since_sync == 1
+
+
+def test_mover_bounds_move_without_position():
+    async def run():
+        ptz = FakePtz()
+        mover = make_mover(ptz, step=5.0)
+        # posが取れていない（GetStatusが位置を返さない機種）
+        await mover.move("left", repeat=MAX_MOVE_REPEAT * 10)
+        return ptz
+
+    ptz = asyncio.run(run())
+    assert ptz.moves == [(pytest.approx(-1.96), 0.0)]
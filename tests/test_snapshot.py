@@ -0,0 +1,26 @@
+import re
+
+from onvif_camera import snapshot
+from onvif_camera.snapshot import now_ts, photo_out_path, unique_path
+
+
+def test_now_ts_format():
+    assert re.fullmatch(r"\d{8}_\d{6}", now_ts())
+
+
+def test_unique_path_adds_counter_in_same_second(tmp_path, monkeypatch):
+    monkeypatch.setattr(snapshot, "now_ts", lambda: "20250101_120000")
+    first = unique_path(tmp_path, "capture", "jpg")
+    assert first.name == "capture_20250101_120000.jpg"
+    first.touch()
+    second = unique_path(tmp_path, "capture", "jpg")
+    assert second.name == "capture_20250101_120000_1.jpg"
+    second.touch()
+    assert unique_path(tmp_path, "capture", "jpg").name == "capture_20250101_120000_2.jpg"
+    # 別の拡張子・別の名前とはぶつからない
+    assert unique_path(tmp_path, "record", "mkv").name == "record_20250101_120000.mkv"
+
+
+def test_photo_out_path_uses_capture_prefix(tmp_path, monkeypatch):
+    monkeypatch.setattr(snapshot, "now_ts", lambda: "20250101_120000")
+    assert photo_out_path(tmp_path) == tmp_path / "capture_20250101_120000.jpg"
@@ -0,0 +1,45 @@
+import asyncio
+
+from onvif_camera.stream import SnapshotPump, jpeg_output_args
+
+
+def test_jpeg_output_args_copies_mjpeg():
+    assert jpeg_output_args("mjpeg") == ["-c:v", "copy", "-bsf:v", "mjpeg2jpeg"]
+
+
+def test_jpeg_output_args_reencodes_others():
+    for codec in ("h264", "hevc", "", None):
+        assert jpeg_output_args(codec) == ["-vcodec", "mjpeg", "-q:v", "2"]
+
+
+def test_read_frames_splits_on_soi_eoi():
+    frame1 = b"\xff\xd8AAAA\xff\xd9"
+    frame2 = b"\xff\xd8BBBB\xff\xd9"
+
+    async def run():
+        pump = SnapshotPump("rtsp://example")
+        reader = asyncio.StreamReader()
+        task = asyncio.create_task(pump._read_frames(reader))
+        seen = []
+
+        async def feed(data):
+            reader.feed_data(data)
+            await asyncio.sleep(0.01)
+            seen.append((pump._latest, pump._seq))
+
+        # 1枚目が途中で切れて、2枚目の頭と一緒に届く
+        await feed(frame1[:3])
+        await feed(frame1[3:] + frame2[:4])
+        await feed(frame2[4:])
+        # 前のゴミのあとに来た1枚
+        await feed(b"junk" + frame1)
+        reader.feed_eof()
+        await task
+        return seen
+
+    assert asyncio.run(run()) == [
+        (None, 0),
+        (frame1, 1),
+        (frame2, 2),
+        (frame1, 3),
+    ]